@@ -0,0 +1,71 @@
+"""
+Created on 16/10/2026
+
+Counts the queries needed to list allocations for a growing number of them.
+
+The count should remain constant regardless of the number of allocations.
+
+Usage:
+    python allocation_queries.py -config ../config.ini
+"""
+
+from argparse import ArgumentParser
+from ptinstancemanager.config import configuration
+
+
+def count_queries(db, func):
+    from sqlalchemy import event
+    executed = []
+    def before_cursor_execute(conn, cursor, statement, *args):
+        executed.append(statement)
+    event.listen(db.engine, 'before_cursor_execute', before_cursor_execute)
+    try:
+        func()
+    finally:
+        event.remove(db.engine, 'before_cursor_execute', before_cursor_execute)
+    return len(executed)
+
+
+def seed(db, num_allocations):
+    from ptinstancemanager.models import Allocation, Instance
+    for i in range(num_allocations):
+        allocation = Allocation()
+        db.session.add(allocation)
+        db.session.flush()
+        instance = Instance('container%d' % i, 39000 + i, 49000 + i)
+        instance.allocated_by = allocation.id
+        db.session.add(instance)
+    db.session.commit()
+
+
+def main(config_file, sizes):
+    configuration.set_file_path(config_file)
+    configuration.config.set('Database', 'uri', 'sqlite://')  # In memory
+    from ptinstancemanager.main import load_app, load_db
+    app = load_app()
+    db = load_db()
+    from ptinstancemanager.models import Allocation
+
+    with app.app_context():
+        print('allocations\tqueries')
+        for size in sizes:
+            db.drop_all()
+            db.create_all()
+            seed(db, size)
+            db.session.expunge_all()  # Start with nothing loaded
+            listing = lambda: [al.serialize('', 'localhost') for al in Allocation.get_current()]
+            print('%d\t%d' % (size, count_queries(db, listing)))
+
+
+def entry_point():
+    parser = ArgumentParser(description='Count the queries needed to list allocations.')
+    parser.add_argument('-config', default='../config.ini', dest='config',
+                        help='Configuration file.')
+    parser.add_argument('-sizes', type=int, nargs='+', default=[10, 100, 1000], dest='sizes',
+                        help='Numbers of allocations to list.')
+    args = parser.parse_args()
+    main(args.config, args.sizes)
+
+
+if __name__ == "__main__":
+    entry_point()
@@ -0,0 +1,215 @@
+"""
+Created on 16/10/2026
+
+Load test of the allocation lifecycle through the HTTP API.
+
+Several concurrent users repeat this cycle until the test ends:
+allocate an instance (POST /allocations), check the allocation (GET) and
+release it (DELETE). Each cycle also lists the cached files (GET /files)
+and, if file URLs are given, caches one of them (POST /files).
+
+By default, the application is loaded in this process through wsgi.main,
+its database is recreated and the simulated Docker backend is used. Tasks
+run eagerly in the threads of the users, as Celery workers would not share
+this database nor the simulated containers. However, Celery does not support
+running eager tasks in several threads at once, so the requests are handled
+one at a time (as a single-threaded server would). Eager tasks cannot be
+retried either, so the simulated boot time is shortened to fit in a single
+readiness check. Redis must be running (for locks and counters).
+
+To test a deployment (e.g., gunicorn and Celery workers), pass its -url.
+
+Usage:
+    python load_test.py -config ../config.ini -users 20 -duration 60
+    python load_test.py -url http://localhost:8000 -users 50 -output results.json
+"""
+
+import json
+import time
+import random
+import threading
+from collections import defaultdict
+from argparse import ArgumentParser
+from ptinstancemanager.config import configuration
+
+
+class InProcessClient(object):
+    """Sends the requests to the application loaded in this process."""
+
+    def __init__(self, app, lock):
+        self.client = app.test_client()
+        self.lock = lock  # Shared by all the clients: one request at a time
+
+    def request(self, method, path, data=None):
+        with self.lock:
+            response = self.client.open(path, method=method, data=data)
+        return response.status_code, response.data
+
+
+class HttpClient(object):
+    """Sends the requests to a running server."""
+
+    def __init__(self, base_url, timeout):
+        import requests
+        self.session = requests.Session()
+        self.base_url = base_url.rstrip('/')
+        self.timeout = timeout
+
+    def request(self, method, path, data=None):
+        response = self.session.request(method, self.base_url + path, data=data, timeout=self.timeout)
+        return response.status_code, response.content
+
+
+class Statistics(object):
+    """Latencies and errors per endpoint (shared by all the users)."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.latencies = defaultdict(list)
+        self.errors = defaultdict(int)
+
+    def record(self, endpoint, latency, failed):
+        with self.lock:
+            self.latencies[endpoint].append(latency)
+            if failed:
+                self.errors[endpoint] += 1
+
+    def summarize(self, elapsed):
+        summary = {}
+        for endpoint, latencies in self.latencies.items():
+            latencies = sorted(latencies)
+            summary[endpoint] = {
+                'requests': len(latencies),
+                'errors': self.errors[endpoint],
+                'error_rate': float(self.errors[endpoint]) / len(latencies),
+                'throughput': len(latencies) / elapsed,
+                'p50_ms': percentile(latencies, 50) * 1000,
+                'p95_ms': percentile(latencies, 95) * 1000,
+                'p99_ms': percentile(latencies, 99) * 1000,
+                'max_ms': latencies[-1] * 1000
+            }
+        return summary
+
+
+def percentile(sorted_values, percent):
+    """Nearest-rank percentile."""
+    rank = int(round(percent / 100.0 * len(sorted_values) + 0.5)) - 1
+    return sorted_values[min(max(rank, 0), len(sorted_values) - 1)]
+
+
+def timed_request(client, statistics, endpoint, method, path, data=None):
+    """Returns the status and body of the response (None if the request failed)."""
+    started = time.time()
+    try:
+        status, body = client.request(method, path, data)
+    except Exception:  # E.g., timeouts or connection errors
+        status, body = None, None
+    statistics.record(endpoint, time.time() - started, status is None or status >= 400)
+    return status, body
+
+
+def run_user(client, statistics, deadline, file_urls, rand):
+    while time.time() < deadline:
+        status, body = timed_request(client, statistics, 'POST /allocations', 'POST', '/allocations')
+        if status == 200:
+            allocation_id = json.loads(body)['id']
+            timed_request(client, statistics, 'GET /allocations/<id>', 'GET', '/allocations/%d' % allocation_id)
+            timed_request(client, statistics, 'DELETE /allocations/<id>', 'DELETE', '/allocations/%d' % allocation_id)
+        else:
+            time.sleep(0.1)  # E.g., no more instances can be created: do not flood the server
+
+        timed_request(client, statistics, 'GET /files', 'GET', '/files')
+        if file_urls:
+            timed_request(client, statistics, 'POST /files', 'POST', '/files', rand.choice(file_urls))
+
+
+# Seconds that a simulated container takes to boot at most.
+# The readiness check waits 2 seconds and it cannot be retried eagerly.
+EAGER_BOOT_TIME = 1.0
+
+
+def load_application(config_file, database):
+    configuration.set_file_path(config_file)
+    configuration.config.set('Docker', 'backend', 'simulated')
+    if database:
+        configuration.config.set('Database', 'uri', database)
+    from ptinstancemanager import wsgi
+    app = wsgi.main(None)  # Already read, reading it again would undo the changes above
+    from ptinstancemanager.app import db, celery
+    from ptinstancemanager.models import init_database
+    # Failures are kept in the results, as with workers (the views get them from there).
+    celery.conf.update(CELERY_ALWAYS_EAGER=True, CELERY_EAGER_PROPAGATES_EXCEPTIONS=False)
+    if app.config['SIMULATION_BOOT_TIME'] > EAGER_BOOT_TIME:
+        print('Simulated boot time shortened to %.1f s.' % EAGER_BOOT_TIME)
+        app.config['SIMULATION_BOOT_TIME'] = EAGER_BOOT_TIME
+    with app.app_context():
+        db.drop_all()
+        db.create_all()
+        init_database(db, app.config['LOWEST_PORT'], app.config['HIGHEST_PORT'])
+    return app
+
+
+def print_summary(summary, elapsed):
+    print('Duration: %.1f s' % elapsed)
+    print('%-28s %9s %7s %9s %9s %9s %9s %9s' %
+          ('endpoint', 'requests', 'errors', 'req/s', 'p50 ms', 'p95 ms', 'p99 ms', 'max ms'))
+    for endpoint in sorted(summary):
+        stats = summary[endpoint]
+        print('%-28s %9d %6.1f%% %9.2f %9.1f %9.1f %9.1f %9.1f' %
+              (endpoint, stats['requests'], stats['error_rate'] * 100, stats['throughput'],
+               stats['p50_ms'], stats['p95_ms'], stats['p99_ms'], stats['max_ms']))
+
+
+def main(args):
+    if args.url:
+        make_client = lambda: HttpClient(args.url, args.timeout)
+    else:
+        app = load_application(args.config, args.database)
+        # While an eager task runs, Celery forbids waiting for results in any thread.
+        lock = threading.Lock()
+        make_client = lambda: InProcessClient(app, lock)
+
+    statistics = Statistics()
+    started = time.time()
+    deadline = started + args.duration
+    users = [threading.Thread(target=run_user,
+                              args=(make_client(), statistics, deadline, args.file_urls, random.Random(i)))
+             for i in range(args.users)]
+    for user in users:
+        user.daemon = True
+        user.start()
+    for user in users:
+        user.join()
+    elapsed = time.time() - started
+
+    summary = statistics.summarize(elapsed)
+    print_summary(summary, elapsed)
+    if args.output:
+        with open(args.output, 'w') as output:
+            json.dump({'users': args.users, 'duration': elapsed, 'endpoints': summary},
+                      output, indent=2, sort_keys=True)
+
+
+def entry_point():
+    parser = ArgumentParser(description='Load test of the allocation lifecycle.')
+    parser.add_argument('-config', default='../config.ini', dest='config',
+                        help='Configuration file (not used with -url).')
+    parser.add_argument('-database', default='sqlite:////tmp/ptloadtest.db', dest='database',
+                        help='Database URI for the application loaded here. Its tables are replaced.')
+    parser.add_argument('-url', dest='url',
+                        help='URL of a running application to test instead of loading it here.')
+    parser.add_argument('-timeout', type=float, default=60, dest='timeout',
+                        help='Seconds to wait for each response (only with -url).')
+    parser.add_argument('-users', type=int, default=10, dest='users',
+                        help='Number of concurrent users.')
+    parser.add_argument('-duration', type=float, default=30, dest='duration',
+                        help='Seconds that the users keep sending requests.')
+    parser.add_argument('-file-urls', nargs='*', default=[], dest='file_urls',
+                        help='URLs of files to cache during the test.')
+    parser.add_argument('-output', dest='output',
+                        help='File to write the results in as JSON.')
+    main(parser.parse_args())
+
+
+if __name__ == "__main__":
+    entry_point()
@@ -0,0 +1,236 @@
+"""
+Created on 16/10/2026
+
+Times the most frequent operations of the models on a database with a realistic volume.
+
+The database is seeded with many finished allocations, thousands of instances
+(most of them finished) and a wide port range. The results are written as JSON
+and, if a baseline is given, each operation is compared with it.
+
+Usage:
+    python model_benchmarks.py -config ../config.ini -output results.json -baseline baseline.json
+
+Timings depend on the machine: measure the baseline on the same machine before
+changing the models (e.g., with -output baseline.json). The baseline stored in
+this folder was measured with the default volume on SQLite in memory.
+
+Any SQLAlchemy URI can be used as database (e.g., postgresql://user@localhost/benchmarks).
+Its tables are dropped and created again, so never use the production database.
+"""
+
+import sys
+import json
+import time
+import random
+import shutil
+import platform
+import tempfile
+from datetime import datetime, timedelta
+from argparse import ArgumentParser
+from ptinstancemanager.config import configuration
+
+
+LOWEST_PORT = 39000
+
+
+def seed(db, cache_dir, num_allocations, num_instances, num_free_ports, num_cached_files):
+    """Fills the database using bulk inserts (the models are not being measured here)."""
+    from ptinstancemanager.models import Allocation, Instance, Port, CachedFile
+    rand = random.Random(0)
+    now = datetime.now()
+    long_ago = now - timedelta(days=30)
+
+    # Half of the active instances are allocated, the rest are waiting or failed.
+    num_allocated = num_instances // 2
+    num_current = min(num_allocated, num_allocations)
+    num_finished = num_allocations - num_current
+    allocations = []
+    for allocation_id in range(1, num_allocations + 1):
+        created_at = long_ago + timedelta(seconds=allocation_id)
+        finished = allocation_id <= num_finished
+        allocations.append({'id': allocation_id, 'created_at': created_at,
+                            'deleted_at': created_at + timedelta(hours=1) if finished else None})
+    db.session.bulk_insert_mappings(Allocation, allocations)
+
+    instances = []
+    ports = []
+    # Each finished allocation left a finished instance behind.
+    for allocation_id in range(1, num_finished + 1):
+        port = LOWEST_PORT + allocation_id % max(num_instances, 1)
+        instances.append({'docker_id': 'finished%d' % allocation_id, 'pt_port': port, 'vnc_port': port + 10000,
+                          'created_at': long_ago, 'deleted_at': now, 'allocated_by': allocation_id,
+                          'status': Instance.READY})
+    for i in range(num_instances):
+        port = LOWEST_PORT + i
+        if i < num_current:
+            allocated_by, status = num_finished + i + 1, Instance.READY
+        else:
+            allocated_by = Instance.NONE
+            status = rand.choice((Instance.READY, Instance.READY, Instance.READY, Instance.STARTING, Instance.ERROR))
+        instances.append({'docker_id': 'active%d' % i, 'pt_port': port, 'vnc_port': port + 10000,
+                          'created_at': now, 'deleted_at': None, 'allocated_by': allocated_by, 'status': status})
+    db.session.bulk_insert_mappings(Instance, instances)
+    db.session.flush()
+
+    active_ids = [row[0] for row in db.session.query(Instance.id).filter(Instance.deleted_at == None).
+                                        order_by(Instance.pt_port)]
+    for i, instance_id in enumerate(active_ids):
+        ports.append({'number': LOWEST_PORT + i, 'instance_id': instance_id})
+    for i in range(num_free_ports):
+        ports.append({'number': LOWEST_PORT + len(active_ids) + i, 'instance_id': Port.UNASSIGNED})
+    db.session.bulk_insert_mappings(Port, ports)
+
+    cached_files = []
+    for i in range(num_cached_files):
+        filename = '%064x.pkt' % i
+        open(cache_dir + filename, 'w').close()
+        cached_files.append({'url': 'http://example.com/files/%d.pkt' % i, 'filename': filename, 'size': 1024,
+                             'created_at': long_ago, 'accessed_at': long_ago, 'validated_at': long_ago})
+    db.session.bulk_insert_mappings(CachedFile, cached_files)
+    db.session.commit()
+    return LOWEST_PORT + len(ports) - 1
+
+
+def measure(db, runs, operations, run, prepare=None):
+    """Calls run() the given number of runs, after prepare() if given.
+        Returns the median and minimum milliseconds per operation."""
+    timings = []
+    for _ in range(runs):
+        if prepare:
+            prepare()
+        db.session.expunge_all()  # Start with nothing loaded
+        started = time.time()
+        run()
+        timings.append((time.time() - started) * 1000.0 / operations)
+    timings.sort()
+    return {'median_ms': round(timings[len(timings) // 2], 4), 'min_ms': round(timings[0], 4),
+            'operations': operations, 'runs': runs}
+
+
+def run_benchmarks(db, cache_dir, num_cached_files, highest_port, runs):
+    from ptinstancemanager import filecache
+    from ptinstancemanager.models import Allocation, Instance, Port, init_database
+    rand = random.Random(1)
+    results = {}
+
+    claimed = []
+    def allocate_ports():
+        for _ in range(20):
+            claimed.append(Port.allocate())
+    def release_ports():
+        while claimed:
+            claimed.pop().release()
+    results['Port.allocate'] = measure(db, runs, 20, allocate_ports, release_ports)
+    release_ports()
+
+    results['Instance.get_deallocated'] = measure(db, runs, 1, lambda: Instance.get_deallocated().all())
+
+    serialize = lambda allocations: [al.serialize('http://localhost/allocations/%d' % al.id, 'localhost')
+                                     for al in allocations]
+    results['Allocation.serialize (current)'] = measure(db, runs, 1, lambda: serialize(Allocation.get_current()))
+    results['Allocation.serialize (all)'] = measure(db, runs, 1, lambda: serialize(Allocation.get_all()))
+
+    def get_cached_files():
+        for _ in range(100):
+            filecache.get_and_update_cached_file('http://example.com/files/%d.pkt' % rand.randrange(num_cached_files))
+    results['get_and_update_cached_file'] = measure(db, runs, 100, get_cached_files)
+
+    # It replaces the ports, so it goes last.
+    def empty_ports():
+        db.session.query(Port).delete()
+        db.session.commit()
+    results['init_database'] = measure(db, runs, 1, lambda: init_database(db, LOWEST_PORT, highest_port),
+                                       empty_ports)
+    return results
+
+
+def compare(results, baseline, tolerance):
+    """Prints how each operation changed. Returns whether any of them got slower."""
+    regressions = False
+    print('%-32s %12s %12s %8s' % ('operation', 'baseline ms', 'current ms', 'ratio'))
+    for name in sorted(results):
+        current = results[name]['median_ms']
+        if name not in baseline:
+            print('%-32s %12s %12.4f %8s' % (name, '-', current, '-'))
+            continue
+        previous = baseline[name]['median_ms']
+        ratio = current / previous if previous else float('inf')
+        verdict = ''
+        if ratio > 1 + tolerance:
+            verdict = 'SLOWER'
+            regressions = True
+        elif ratio < 1 - tolerance:
+            verdict = 'faster'
+        print('%-32s %12.4f %12.4f %8.2f %s' % (name, previous, current, ratio, verdict))
+    return regressions
+
+
+def main(args):
+    configuration.set_file_path(args.config)
+    configuration.config.set('Database', 'uri', args.database)
+    from ptinstancemanager.main import load_app, load_db
+    app = load_app()
+    db = load_db()
+
+    cache_dir = tempfile.mkdtemp(prefix='ptbenchmark') + '/'
+    app.config['CACHE_DIR'] = cache_dir
+    try:
+        with app.app_context():
+            db.drop_all()
+            db.create_all()
+            highest_port = seed(db, cache_dir, args.allocations, args.instances, args.free_ports, args.cached_files)
+            results = run_benchmarks(db, cache_dir, args.cached_files, highest_port, args.runs)
+            database = db.engine.dialect.name
+            db.drop_all()
+    finally:
+        shutil.rmtree(cache_dir)
+
+    report = {
+        'database': database,
+        'python': platform.python_version(),
+        'sizes': {'allocations': args.allocations, 'instances': args.instances,
+                  'ports': highest_port - LOWEST_PORT + 1, 'cached_files': args.cached_files},
+        'results': results
+    }
+    if args.output:
+        with open(args.output, 'w') as output:
+            json.dump(report, output, indent=2, sort_keys=True)
+    else:
+        print(json.dumps(report, indent=2, sort_keys=True))
+
+    if args.baseline:
+        with open(args.baseline) as baseline_file:
+            baseline = json.load(baseline_file)
+        if baseline.get('sizes') != report['sizes'] or baseline.get('database') != database:
+            print('Warning: the baseline was measured with a different database or volume.')
+        return 1 if compare(results, baseline['results'], args.tolerance) else 0
+    return 0
+
+
+def entry_point():
+    parser = ArgumentParser(description='Time the most frequent operations of the models.')
+    parser.add_argument('-config', default='../config.ini', dest='config',
+                        help='Configuration file.')
+    parser.add_argument('-database', default='sqlite://', dest='database',
+                        help='Database URI (by default, SQLite in memory). Its tables are replaced.')
+    parser.add_argument('-allocations', type=int, default=10000, dest='allocations',
+                        help='Number of allocations (most of them finished).')
+    parser.add_argument('-instances', type=int, default=2000, dest='instances',
+                        help='Number of active instances (half of them allocated).')
+    parser.add_argument('-free-ports', type=int, default=500, dest='free_ports',
+                        help='Number of ports available for new instances.')
+    parser.add_argument('-cached-files', type=int, default=1000, dest='cached_files',
+                        help='Number of files cached.')
+    parser.add_argument('-runs', type=int, default=5, dest='runs',
+                        help='Times that each operation is measured (the median is reported).')
+    parser.add_argument('-output', dest='output',
+                        help='File to write the results in (by default, they are printed).')
+    parser.add_argument('-baseline', dest='baseline',
+                        help='Results to compare with (e.g., baseline.json).')
+    parser.add_argument('-tolerance', type=float, default=0.2, dest='tolerance',
+                        help='Relative change tolerated before reporting an operation as slower or faster.')
+    sys.exit(main(parser.parse_args()))
+
+
+if __name__ == "__main__":
+    entry_point()
@@ -33,6 +33,7 @@ setup(name="ptinstancemanager",
             "flasgger",
             "celery",
             "redis",
+            "requests",
             "ptchecker",
             "psutil"
       ],
@@ -42,6 +43,7 @@ setup(name="ptinstancemanager",
       entry_points={
           'console_scripts': [
               'run-api = ptinstancemanager.run:entry_point',
+              'watch-containers = ptinstancemanager.watcher:entry_point',
           ],
       },
 )
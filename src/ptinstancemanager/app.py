@@ -5,6 +5,7 @@ Created on 13/07/2015
 """
 
 import logging
+from redis import StrictRedis
 from flask import Flask
 from kombu import Queue
 from celery import Celery
@@ -37,35 +38,80 @@ app = Flask(__name__)
 app.config['SQLALCHEMY_DATABASE_URI'] = configuration.get_database_uri()
 app.config['LOWEST_PORT'] = configuration.get_lowest_port()
 app.config['HIGHEST_PORT'] = configuration.get_highest_port()
+app.config['VNC_PORT_OFFSET'] = configuration.get_vnc_port_offset()
 app.config['MAXIMUM_CPU'] = configuration.get_maximum_cpu()
 app.config['MAXIMUM_MEMORY'] = configuration.get_maximum_memory()
+app.config['SAMPLE_INTERVAL'] = configuration.get_sample_interval()
+app.config['SAMPLE_SMOOTHING'] = configuration.get_sample_smoothing()
 app.config['DOCKER_URL'] =  configuration.get_docker_url()
 app.config['DOCKER_IMAGE'] = configuration.get_docker_image_name()
 app.config['DOCKER_DATA_ONLY'] = configuration.get_docker_data_container()
 app.config['DOCKER_VNC_PORT'] =  configuration.get_docker_vnc_port()
 app.config['DOCKER_PT_PORT'] =  configuration.get_docker_pt_port()
+app.config['DOCKER_API_VERSION'] =  configuration.get_docker_api_version()
+app.config['DOCKER_HEALTH_CHECK'] =  configuration.get_docker_health_check()
+app.config['DOCKER_PARALLELISM'] =  configuration.get_docker_parallelism()
+app.config['DOCKER_BACKEND'] =  configuration.get_docker_backend()
+app.config['SIMULATION_LATENCIES'] = dict((operation, configuration.get_simulated_latency(operation))
+                                          for operation in ('create', 'start', 'pause', 'unpause', 'remove'))
+app.config['SIMULATION_BOOT_TIME'] = configuration.get_simulated_boot_time()
+app.config['SIMULATION_FAILURE_RATE'] = configuration.get_simulated_failure_rate()
+app.config['SIMULATION_MEAN_LIFETIME'] = configuration.get_simulated_mean_lifetime()
+app.config['SIMULATION_EXIT_CODES'] = configuration.get_simulated_exit_codes()
+app.config['SIMULATION_SEED'] = configuration.get_simulation_seed()
 app.config['CACHE_DIR'] =  configuration.get_cache_directory()
 app.config['CACHE_CONTAINER_DIR'] =  configuration.get_container_directory()
+app.config['CACHE_MAX_FILE_SIZE'] =  configuration.get_maximum_file_size()
+app.config['CACHE_MAX_SIZE'] =  configuration.get_maximum_cache_size()
+app.config['CACHE_MAX_FILES'] =  configuration.get_maximum_cached_files()
+app.config['CACHE_EVICTION_INTERVAL'] =  configuration.get_eviction_interval()
+app.config['CACHE_MAX_AGE'] =  configuration.get_cache_max_age()
+app.config['CACHE_DOWNLOAD_WAIT'] =  configuration.get_download_wait()
+app.config['CACHE_PREFETCH_PARALLELISM'] =  configuration.get_prefetch_parallelism()
+app.config['CACHE_CONNECT_TIMEOUT'] =  configuration.get_connect_timeout()
+app.config['CACHE_READ_TIMEOUT'] =  configuration.get_read_timeout()
+app.config['POOL_MIN_IDLE'] = configuration.get_pool_min_idle()
+app.config['POOL_MAX_IDLE'] = configuration.get_pool_max_idle()
+app.config['POOL_REFILL_RATE'] = configuration.get_pool_refill_rate()
+app.config['POOL_CHECK_INTERVAL'] = configuration.get_pool_check_interval()
+app.config['TRACE_SLOW_THRESHOLD'] = configuration.get_trace_slow_threshold()
+app.config['TRACE_RETENTION'] = configuration.get_trace_retention()
 app.config['CELERY_BROKER_URL'] = configuration.get_celery_broker_url()
 app.config['CELERY_RESULT_BACKEND'] = configuration.get_celery_broker_url()
 app.config['CELERY_TASK_EXPIRATION'] = configuration.get_task_expiration()
+app.config['MAXIMUM_WAIT'] = configuration.get_maximum_wait()
+app.config['MONITOR_INTERVAL'] = configuration.get_monitor_interval()
 app.config['CELERY_IMPORTS'] = ('ptinstancemanager.tasks',)
 app.config['CELERY_CREATE_MISSING_QUEUES'] = True
 app.config['CELERY_ROUTES'] = {
     'ptinstancemanager.tasks.allocate_instance': {
         'queue': 'priority_high',
     },
+    'ptinstancemanager.tasks.allocate_instances': {
+        'queue': 'priority_high',
+    },
     'ptinstancemanager.tasks.deallocate_instance': {
         'queue': 'priority_high',
     },
 }
 app.config['CELERYBEAT_SCHEDULE'] = {
-    'monitor-every-5-minutes': {
+    # Reconciliation in case the watcher missed any Docker event
+    'monitor-containers': {
         'task': 'ptinstancemanager.tasks.monitor_containers',
-        'schedule': timedelta(minutes=5)
+        'schedule': timedelta(minutes=app.config['MONITOR_INTERVAL'])
+    },
+    'evict-cached-files': {
+        'task': 'ptinstancemanager.tasks.evict_cached_files',
+        'schedule': timedelta(minutes=app.config['CACHE_EVICTION_INTERVAL'])
+    },
+    'maintain-pool': {
+        'task': 'ptinstancemanager.tasks.maintain_pool',
+        'schedule': timedelta(seconds=app.config['POOL_CHECK_INTERVAL'])
     },
 }
 app.config['PT_CHECKER'] = configuration.get_jar_path()
+app.config['PT_CHECKER_BACKEND'] = configuration.get_pt_checker_backend()
+app.config['PT_CHECKER_QUIET_PERIOD'] = configuration.get_pt_checker_quiet_period()
 app.config['SWAGGER'] = {
     "swagger_version": "2.0",
     "title": "pt-instances-management",
@@ -83,3 +129,6 @@ db = SQLAlchemy(app)
 
 # Configure celery
 celery = make_celery(app)
+
+# Shared store for the figures which must be seen by both web and worker processes
+redis_store = StrictRedis.from_url(app.config['CELERY_BROKER_URL'])
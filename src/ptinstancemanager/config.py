@@ -18,6 +18,12 @@ class ConfigFileReader(object):
         if file_path:  # Ignore if it is None
             self.config.read(file_path)
 
+    def __get(self, section, option, default):
+        # For options added later: old configuration files might not have them.
+        if self.config.has_option(section, option):
+            return self.config.get(section, option)
+        return default
+
     def get_log(self):
         return self.config.get('Log', 'file')
 
@@ -36,6 +42,37 @@ class ConfigFileReader(object):
     def get_docker_pt_port(self):
         return int(self.config.get('Docker', 'pt_port'))
 
+    def get_docker_api_version(self):
+        return self.__get('Docker', 'api_version', 'auto')
+
+    def get_docker_health_check(self):
+        return int(self.__get('Docker', 'health_check', 60))
+
+    def get_docker_parallelism(self):
+        return int(self.__get('Docker', 'parallelism', 8))
+
+    def get_docker_backend(self):
+        return self.__get('Docker', 'backend', 'docker')
+
+    def get_simulated_latency(self, operation):
+        return float(self.__get('Simulation', operation + '_latency', 0))
+
+    def get_simulated_boot_time(self):
+        return float(self.__get('Simulation', 'boot_time', 0))
+
+    def get_simulated_failure_rate(self):
+        return float(self.__get('Simulation', 'failure_rate', 0))
+
+    def get_simulated_mean_lifetime(self):
+        return float(self.__get('Simulation', 'mean_lifetime', 0))
+
+    def get_simulated_exit_codes(self):
+        return [int(code) for code in self.__get('Simulation', 'exit_codes', '0').split(',')]
+
+    def get_simulation_seed(self):
+        seed = self.__get('Simulation', 'seed', '')
+        return int(seed) if seed else None
+
     def get_database_uri(self):
         return self.config.get('Database', 'uri')
 
@@ -45,9 +82,21 @@ class ConfigFileReader(object):
     def get_task_expiration(self):
         return int(self.config.get('Celery', 'task_expiration'))
 
+    def get_maximum_wait(self):
+        return float(self.__get('Celery', 'maximum_wait', 30))
+
+    def get_monitor_interval(self):
+        return int(self.__get('Celery', 'monitor_interval', 5))
+
     def get_jar_path(self):
         return self.config.get('PTChecker', 'jar_path')
 
+    def get_pt_checker_backend(self):
+        return self.__get('PTChecker', 'backend', 'socket')
+
+    def get_pt_checker_quiet_period(self):
+        return float(self.__get('PTChecker', 'quiet_period', 0.3))
+
     def get_cache_directory(self):
         ret = self.config.get('CachedFiles', 'cache_dir')
         return ret if ret.endswith('/') else ret + '/'
@@ -56,17 +105,71 @@ class ConfigFileReader(object):
         ret = self.config.get('CachedFiles', 'container_dir')
         return ret if ret.endswith('/') else ret + '/'
 
+    def get_maximum_file_size(self):
+        return int(self.__get('CachedFiles', 'max_size', 100 * 1024 * 1024))
+
+    def get_maximum_cache_size(self):
+        return int(self.__get('CachedFiles', 'quota_size', 0))
+
+    def get_maximum_cached_files(self):
+        return int(self.__get('CachedFiles', 'quota_files', 0))
+
+    def get_eviction_interval(self):
+        return int(self.__get('CachedFiles', 'eviction_interval', 10))
+
+    def get_cache_max_age(self):
+        return int(self.__get('CachedFiles', 'max_age', 0))
+
+    def get_download_wait(self):
+        return int(self.__get('CachedFiles', 'download_wait', 120))
+
+    def get_prefetch_parallelism(self):
+        return int(self.__get('CachedFiles', 'prefetch_parallelism', 4))
+
+    def get_connect_timeout(self):
+        return float(self.__get('CachedFiles', 'connect_timeout', 5))
+
+    def get_read_timeout(self):
+        return float(self.__get('CachedFiles', 'read_timeout', 30))
+
     def get_maximum_cpu(self):
         return float(self.config.get('Thresholds', 'cpu'))
 
     def get_maximum_memory(self):
         return float(self.config.get('Thresholds', 'memory'))
 
+    def get_sample_interval(self):
+        return float(self.__get('Thresholds', 'sample_interval', 1.0))
+
+    def get_sample_smoothing(self):
+        return float(self.__get('Thresholds', 'sample_smoothing', 0.3))
+
     def get_lowest_port(self):
         return int(self.config.get('Thresholds', 'lowest_port'))
 
     def get_highest_port(self):
         return int(self.config.get('Thresholds', 'highest_port'))
 
+    def get_vnc_port_offset(self):
+        return int(self.__get('Thresholds', 'vnc_port_offset', 10000))
+
+    def get_pool_min_idle(self):
+        return int(self.__get('Pool', 'min_idle', 0))
+
+    def get_pool_max_idle(self):
+        return int(self.__get('Pool', 'max_idle', 0))
+
+    def get_pool_refill_rate(self):
+        return int(self.__get('Pool', 'refill_rate', 1))
+
+    def get_pool_check_interval(self):
+        return int(self.__get('Pool', 'check_interval', 30))
+
+    def get_trace_slow_threshold(self):
+        return float(self.__get('Tracing', 'slow_threshold', 5.0))
+
+    def get_trace_retention(self):
+        return int(self.__get('Tracing', 'retention', 86400))
+
 
 configuration = ConfigFileReader()
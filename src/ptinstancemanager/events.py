@@ -0,0 +1,86 @@
+"""
+Created on 16/10/2026
+
+Supervision of the containers based on the events sent by Docker.
+"""
+
+import time
+import logging
+from docker.errors import APIError
+from ptinstancemanager import tasks
+from ptinstancemanager.app import app, db
+from ptinstancemanager.models import Instance
+
+
+logger = logging.getLogger()
+
+WATCHED_EVENTS = ('die', 'oom', 'pause', 'unpause', 'destroy')
+
+
+def get_exit_code(docker, event):
+    attributes = event.get('Actor', {}).get('Attributes', {})
+    if 'exitCode' in attributes:
+        return int(attributes['exitCode'])
+    # Older daemons do not include it in the event.
+    return docker.inspect_container(event['id'])['State']['ExitCode']
+
+
+def handle_event(docker, event):
+    """Updates the instance of the container which originated the event."""
+    status = event.get('status')
+    instance = Instance.get_by_docker_id(event.get('id'))
+    if not instance or not instance.is_active():
+        return  # E.g., containers removed by us after deleting their instance.
+
+    logger.info('Docker event "%s" on %s.' % (status, instance))
+    if status == 'die':
+        if get_exit_code(docker, event) == 0:
+            # Restart stopped containers (which exited successfully)
+            instance.mark_starting()
+            tasks.restart_container.s(instance.id).delay()
+        else:
+            instance.mark_error()
+            tasks.delete_erroneous.s().delay()
+    elif status == 'oom':
+        # The 'die' event will follow.
+        instance.mark_error()
+    elif status == 'destroy':
+        # Nothing to remove, the container no longer exists.
+        instance.delete()
+    # 'pause' and 'unpause' are caused by (de)allocations, so they only get logged.
+
+
+def watch_events(reconnection_delay=5):
+    """Handles the events of packettracer containers until the process is stopped."""
+    # Whatever happened before the watcher started
+    tasks.monitor_containers.s().delay()
+    # On reconnection, get the ones sent meanwhile (even if none was received before).
+    since = int(time.time())
+    # 'since' is inclusive and has second resolution, so the events of that second
+    # are sent again: remember the ones handled to skip them.
+    handled = set()
+    filters = {'image': app.config['DOCKER_IMAGE'], 'event': list(WATCHED_EVENTS)}
+    while True:
+        try:
+            docker = tasks.get_docker_client()
+            for event in docker.events(since=since, filters=filters, decode=True):
+                # The status too: older daemons do not send 'timeNano'.
+                key = (event.get('id'), event.get('status'), event.get('timeNano'))
+                if key in handled:
+                    continue
+                event_time = event.get('time', since)
+                if event_time > since:
+                    since = event_time
+                    handled = set()
+                handled.add(key)
+                try:
+                    handle_event(docker, event)
+                except APIError as ae:
+                    logger.error('Error handling Docker event %s.' % event)
+                    logger.error('Docker API exception. %s.' % ae)
+                finally:
+                    db.session.remove()  # Do not keep stale instances between events
+        except Exception as e:
+            # E.g., the stream times out when there are no events for a while.
+            logger.warning('Docker events stream interrupted. %s.' % e)
+            time.sleep(reconnection_delay)
@@ -11,4 +11,14 @@ class InsufficientResourcesError(Exception):
 
 class DockerContainerError(Exception):
     def __init__(self, message):
-        super(InsufficientResourcesError, self).__init__(message)
+        super(DockerContainerError, self).__init__(message)
+
+
+class FileTooLargeError(Exception):
+    def __init__(self, message):
+        super(FileTooLargeError, self).__init__(message)
+
+
+class DownloadInProgressError(Exception):
+    def __init__(self, message):
+        super(DownloadInProgressError, self).__init__(message)
@@ -0,0 +1,282 @@
+"""
+Created on 16/10/2026
+
+Storage of the Packet Tracer files cached.
+
+Files are stored by content (named after their SHA-256 hash), so the same
+file downloaded from different URLs is stored only once. Each URL cached
+is a CachedFile and several of them might share the same file.
+"""
+
+import os
+import time
+import errno
+import hashlib
+import logging
+import tempfile
+import requests
+from collections import namedtuple, OrderedDict
+from multiprocessing.pool import ThreadPool
+from redis.exceptions import LockError
+from sqlalchemy.exc import IntegrityError
+from ptinstancemanager.app import app, db, redis_store
+from ptinstancemanager.models import CachedFile, unit_of_work
+from ptinstancemanager.exceptions import FileTooLargeError, DownloadInProgressError
+
+
+logger = logging.getLogger()
+
+CHUNK_SIZE = 64 * 1024
+
+Download = namedtuple('Download', ('filename', 'size', 'etag', 'last_modified'))
+
+
+def delete(cached_file):
+    """Deletes the cached URL and its file if no other URL uses it.
+        Returns whether the file was deleted."""
+    filename = cached_file.filename
+    CachedFile.delete(cached_file)
+    return remove_if_unused(filename)
+
+
+def remove_if_unused(filename):
+    """Removes the file unless a cached URL uses it.
+        Returns whether the file was removed."""
+    if CachedFile.count_by_filename(filename):
+        return False
+    try:
+        os.remove(app.config['CACHE_DIR'] + filename)
+    except OSError as e:  # E.g., if the file does not exist.
+        if e.errno!=errno.ENOENT:
+            raise  # E.g., permission denied
+        # We wanted to delete it anyway so go ahead
+    return True
+
+
+def get_and_update_cached_file(file_url):
+    """Returns cached file for the given URL only if the file exists."""
+    cached_file = CachedFile.get(file_url)
+    if cached_file:
+        # check if the file still exists and remove the object from the DB otherwise
+        if os.path.isfile(app.config['CACHE_DIR'] + cached_file.filename):
+            cached_file.touch()
+            return cached_file
+        CachedFile.delete(cached_file)  # else
+    return None
+
+
+def is_over_quota(total_size, total_files):
+    max_size = app.config['CACHE_MAX_SIZE']
+    max_files = app.config['CACHE_MAX_FILES']
+    return (max_size and total_size > max_size) or (max_files and total_files > max_files)
+
+
+def evict():
+    """Deletes the least recently used files until the cache fits in its quota.
+        Returns the URLs of the deleted files."""
+    total_size = CachedFile.get_total_size()
+    total_files = CachedFile.get_count()
+    evicted = []
+    if is_over_quota(total_size, total_files):
+        for cached_file in CachedFile.get_least_recently_used().all():
+            if not is_over_quota(total_size, total_files):
+                break
+            logger.info('Evicting %s from the cache.' % cached_file)
+            size = cached_file.size or 0
+            evicted.append(cached_file.url)
+            total_files -= 1
+            if delete(cached_file):
+                total_size -= size  # Otherwise, other URLs still use it
+    return evicted
+
+
+def download(file_url, etag=None, last_modified=None):
+    """Stores the file in the cache directory.
+
+    The file is written in a temporary file first, so the cache never
+    contains incomplete files. If validators of a previous download are
+    given, returns None when the file has not changed since then.
+    """
+    headers = {}
+    if etag:
+        headers['If-None-Match'] = etag
+    if last_modified:
+        headers['If-Modified-Since'] = last_modified
+    max_size = app.config['CACHE_MAX_FILE_SIZE']
+    started = time.time()
+    response = requests.get(file_url, headers=headers, stream=True,
+                            timeout=(app.config['CACHE_CONNECT_TIMEOUT'], app.config['CACHE_READ_TIMEOUT']))
+    try:
+        if response.status_code == 304:
+            logger.info('%s has not been modified.' % file_url)
+            return None
+        response.raise_for_status()
+        if int(response.headers.get('Content-Length', 0)) > max_size:
+            raise FileTooLargeError('The file exceeds the maximum size allowed (%d bytes).' % max_size)
+
+        size = 0
+        content_hash = hashlib.sha256()
+        tmp = tempfile.NamedTemporaryFile(dir=app.config['CACHE_DIR'], prefix='.download-', delete=False)
+        try:
+            with tmp:
+                for chunk in response.iter_content(CHUNK_SIZE):
+                    size += len(chunk)
+                    if size > max_size:
+                        raise FileTooLargeError('The file exceeds the maximum size allowed (%d bytes).' % max_size)
+                    content_hash.update(chunk)
+                    tmp.write(chunk)
+            filename = content_hash.hexdigest() + '.pkt'
+            if os.path.isfile(app.config['CACHE_DIR'] + filename):
+                os.remove(tmp.name)  # Already cached from another URL
+            else:
+                os.rename(tmp.name, app.config['CACHE_DIR'] + filename)  # Atomic
+        except:
+            os.remove(tmp.name)
+            raise
+    finally:
+        response.close()
+
+    elapsed = time.time() - started
+    logger.info('Downloaded %s: %d bytes in %.3f s (%.1f KB/s).' %
+                (file_url, size, elapsed, size / 1024.0 / elapsed if elapsed else 0))
+    return Download(filename, size, response.headers.get('ETag'), response.headers.get('Last-Modified'))
+
+
+def revalidate(cached_file):
+    """Downloads the file again only if it has changed in the server."""
+    try:
+        downloaded = download(cached_file.url, cached_file.etag, cached_file.last_modified)
+    except (IOError, FileTooLargeError) as e:
+        logger.warning('%s could not be revalidated, the cached copy is still used. %s' % (cached_file, e))
+        return
+    if downloaded is None:
+        cached_file.mark_validated()
+    else:
+        previous_filename = cached_file.filename
+        cached_file.update(downloaded.filename, downloaded.size, downloaded.etag, downloaded.last_modified)
+        if previous_filename != downloaded.filename:
+            remove_if_unused(previous_filename)
+
+
+def cache(file_url, max_age=None):
+    """Returns the cached file for the given URL, downloading it if needed.
+
+    Files cached for longer than their maximum age are revalidated.
+    Concurrent requests for the same URL (from any process) wait for the
+    one which is downloading it instead of downloading it again.
+    """
+    default_max_age = app.config['CACHE_MAX_AGE']
+    cached_file = get_and_update_cached_file(file_url)
+    if cached_file and not cached_file.is_stale(default_max_age):
+        return cached_file
+
+    lock = get_download_lock(file_url)
+    if not lock.acquire():
+        raise DownloadInProgressError('The file is still being downloaded. Please, wait and retry it.')
+    try:
+        # Downloaded by another request while this one was waiting?
+        db.session.expire_all()
+        cached_file = get_and_update_cached_file(file_url)
+        if cached_file:
+            if cached_file.is_stale(default_max_age):
+                revalidate(cached_file)
+            return cached_file
+        downloaded = download(file_url)
+        try:
+            return CachedFile.create(file_url, downloaded.filename, downloaded.size,
+                                     downloaded.etag, downloaded.last_modified, max_age)
+        except IntegrityError:
+            # The lock expired and another request cached it meanwhile.
+            db.session.rollback()
+            return CachedFile.get(file_url)
+    finally:
+        release_download_lock(lock, file_url)
+
+
+def get_download_lock(file_url):
+    """Lock held while the URL is being downloaded by any process.
+
+    Prefetching acquires it in a worker thread and releases it from
+    another one, so its token is not stored per thread.
+    """
+    wait = app.config['CACHE_DOWNLOAD_WAIT']
+    return redis_store.lock('ptinstancemanager:download:' + hashlib.sha1(file_url).hexdigest(),
+                            timeout=wait, blocking_timeout=wait, thread_local=False)
+
+
+def release_download_lock(lock, file_url):
+    try:
+        lock.release()
+    except LockError:
+        logger.warning('The download lock of %s expired before the download finished.' % file_url)
+
+
+def prefetch_one(file_url):
+    """Downloads the URL unless another request is already doing it.
+        Returns the URL, the lock held, the download and the error raised."""
+    lock = get_download_lock(file_url)
+    if not lock.acquire(blocking=False):
+        return file_url, None, None, DownloadInProgressError('The file is being downloaded by another request.')
+    try:
+        return file_url, lock, download(file_url), None
+    except (IOError, ValueError, FileTooLargeError) as e:
+        release_download_lock(lock, file_url)
+        return file_url, None, None, e
+
+
+def store_downloads(downloads, max_age):
+    """Creates the cached files of the downloaded URLs in a single batch."""
+    cached_files = [CachedFile(url, d.filename, d.size, d.etag, d.last_modified, max_age)
+                    for url, d in downloads]
+    try:
+        CachedFile.create_many(cached_files)
+    except IntegrityError:
+        # Cached meanwhile by a request whose lock had expired.
+        db.session.rollback()
+        for cached_file in cached_files:
+            if not CachedFile.get(cached_file.url):
+                CachedFile.create(cached_file.url, cached_file.filename, cached_file.size,
+                                  cached_file.etag, cached_file.last_modified, max_age)
+
+
+def prefetch(file_urls, max_age=None):
+    """Caches several URLs, downloading the missing ones in parallel.
+
+    It is a generator which yields the outcome of each URL as soon as it
+    is known. The new files are stored once all of them have finished.
+    """
+    file_urls = list(OrderedDict.fromkeys(file_urls))  # Without duplicates
+    cached = set()
+    with unit_of_work():  # Updated in a single transaction
+        for cached_file in CachedFile.get_many(file_urls):
+            if os.path.isfile(app.config['CACHE_DIR'] + cached_file.filename):
+                cached_file.touch()
+                cached.add(cached_file.url)
+            else:
+                CachedFile.delete(cached_file)  # It will be downloaded again
+    for file_url in cached:
+        yield {'url': file_url, 'status': 'cached'}
+
+    missing = [file_url for file_url in file_urls if file_url not in cached]
+    if not missing:
+        return
+    workers = ThreadPool(min(len(missing), app.config['CACHE_PREFETCH_PARALLELISM']))
+    locks = []
+    downloads = []
+    try:
+        for file_url, lock, downloaded, error in workers.imap_unordered(prefetch_one, missing):
+            if lock:
+                locks.append((lock, file_url))
+            if downloaded:
+                downloads.append((file_url, downloaded))
+                yield {'url': file_url, 'status': 'downloaded', 'size': downloaded.size}
+            elif isinstance(error, DownloadInProgressError):
+                yield {'url': file_url, 'status': 'downloading', 'error': str(error)}
+            else:
+                logger.warning('Error prefetching %s. %s' % (file_url, error))
+                yield {'url': file_url, 'status': 'failed', 'error': str(error)}
+        store_downloads(downloads, max_age)
+    finally:
+        workers.close()
+        for lock, file_url in locks:
+            release_download_lock(lock, file_url)
@@ -0,0 +1,121 @@
+"""
+Created on 16/10/2026
+
+Metrics exported in the Prometheus text format.
+
+The durations of the tasks are observed in the workers but exported by
+the web application, so their histograms are stored in Redis. Gauges
+are computed whenever the metrics are requested.
+"""
+
+import time
+import logging
+from functools import wraps
+from redis.exceptions import RedisError
+from celery.exceptions import Retry
+from ptinstancemanager import pool
+from ptinstancemanager.app import app, redis_store
+from ptinstancemanager.models import Instance, Port, CachedFile
+
+
+HISTOGRAM_KEY = 'ptinstancemanager:metrics:%s'
+BUCKETS = (0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120)  # In seconds
+
+timed_tasks = []  # Names of the histograms, in registration order
+
+logger = logging.getLogger()
+
+
+def observe(name, seconds, failed=False):
+    """Adds a duration to the histogram of the given name."""
+    key = HISTOGRAM_KEY % name
+    pipe = redis_store.pipeline()
+    for bound in BUCKETS:
+        if seconds <= bound:  # Buckets are cumulative
+            pipe.hincrby(key, 'le:%g' % bound, 1)
+    pipe.hincrby(key, 'count', 1)
+    pipe.hincrbyfloat(key, 'sum', seconds)
+    if failed:
+        pipe.hincrby(key, 'failures', 1)
+    try:
+        pipe.execute()
+    except RedisError as e:  # Metrics are not worth failing the task
+        logger.warning('The duration of %s could not be recorded. %s' % (name, e))
+
+
+def timed(name):
+    """Records how long each call to the decorated function takes and whether it fails."""
+    def timed_decorator(func):
+        timed_tasks.append(name)
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            started = time.time()
+            failed = True
+            try:
+                result = func(*args, **kwargs)
+                failed = False
+                return result
+            except Retry:
+                failed = False  # It will be tried again
+                raise
+            finally:
+                observe(name, time.time() - started, failed)
+        return wrapper
+    return timed_decorator
+
+
+def get_queue_names():
+    queues = set(route['queue'] for route in app.config['CELERY_ROUTES'].values())
+    queues.add(app.config.get('CELERY_DEFAULT_QUEUE', 'celery'))
+    return sorted(queues)
+
+
+def format_metric(lines, name, metric_type, description, samples):
+    """Appends a metric and its samples given as (labels, value) pairs."""
+    lines.append('# HELP %s %s' % (name, description))
+    lines.append('# TYPE %s %s' % (name, metric_type))
+    for labels, value in samples:
+        if labels:
+            name_with_labels = '%s{%s}' % (name, ','.join('%s="%s"' % label for label in labels))
+        else:
+            name_with_labels = name
+        lines.append('%s %s' % (name_with_labels, value))
+
+
+def render():
+    """Returns all the metrics in the Prometheus text format."""
+    lines = []
+    histograms = [(task, redis_store.hgetall(HISTOGRAM_KEY % task)) for task in timed_tasks]
+
+    lines.append('# HELP ptinstancemanager_task_duration_seconds Duration of the tasks.')
+    lines.append('# TYPE ptinstancemanager_task_duration_seconds histogram')
+    for task, stored in histograms:
+        for bound in BUCKETS:
+            lines.append('ptinstancemanager_task_duration_seconds_bucket{task="%s",le="%g"} %d' %
+                         (task, bound, int(stored.get('le:%g' % bound, 0))))
+        count = int(stored.get('count', 0))
+        lines.append('ptinstancemanager_task_duration_seconds_bucket{task="%s",le="+Inf"} %d' % (task, count))
+        lines.append('ptinstancemanager_task_duration_seconds_sum{task="%s"} %r' %
+                     (task, float(stored.get('sum', 0))))
+        lines.append('ptinstancemanager_task_duration_seconds_count{task="%s"} %d' % (task, count))
+
+    format_metric(lines, 'ptinstancemanager_task_failures_total', 'counter', 'Tasks which raised an error.',
+                  [((('task', task),), int(stored.get('failures', 0))) for task, stored in histograms])
+
+    pool_stats = pool.get_stats()
+    format_metric(lines, 'ptinstancemanager_pool_hits_total', 'counter',
+                  'Allocations served by an already running instance.', [((), pool_stats['hits'])])
+    format_metric(lines, 'ptinstancemanager_pool_misses_total', 'counter',
+                  'Allocations which had to wait for a new instance.', [((), pool_stats['misses'])])
+
+    format_metric(lines, 'ptinstancemanager_instances', 'gauge', 'Active instances by status.',
+                  [((('status', status),), count) for status, count in sorted(Instance.count_by_status().items())])
+    format_metric(lines, 'ptinstancemanager_free_ports', 'gauge', 'Ports which can be used by new instances.',
+                  [((), Port.get_available().count())])
+    format_metric(lines, 'ptinstancemanager_cached_files', 'gauge', 'URLs cached.',
+                  [((), CachedFile.get_count())])
+    format_metric(lines, 'ptinstancemanager_cached_bytes', 'gauge', 'Size of the files cached.',
+                  [((), CachedFile.get_total_size())])
+    format_metric(lines, 'ptinstancemanager_queue_length', 'gauge', 'Tasks waiting in each Celery queue.',
+                  [((('queue', queue),), redis_store.llen(queue)) for queue in get_queue_names()])
+    return '\n'.join(lines) + '\n'
@@ -0,0 +1,116 @@
+"""
+Created on 16/10/2026
+
+Upgrades existing databases to the current schema without recreating them.
+
+Each migration is applied once and in order. The last one applied is
+stored in the 'schema_version' table. Databases created before this
+module existed are considered to be in version 0.
+"""
+
+import os
+import logging
+from datetime import datetime
+from sqlalchemy import inspect
+from ptinstancemanager.app import app
+from ptinstancemanager.models import SchemaVersion, CachedFile, commit
+
+
+logger = logging.getLogger()
+
+
+def create_missing_indexes(db):
+    inspector = inspect(db.engine)
+    for table in db.metadata.sorted_tables:
+        existing = set(index['name'] for index in inspector.get_indexes(table.name))
+        columns = set(column['name'] for column in inspector.get_columns(table.name))
+        for index in table.indexes:
+            # Indexes on columns added by later migrations are created by them.
+            if index.name not in existing and all(c.name in columns for c in index.columns):
+                logger.info('Creating index %s.' % index.name)
+                index.create(bind=db.engine)
+
+
+def add_missing_columns(db):
+    inspector = inspect(db.engine)
+    for table in db.metadata.sorted_tables:
+        existing = set(column['name'] for column in inspector.get_columns(table.name))
+        for column in table.columns:
+            if column.name not in existing:
+                logger.info('Adding column %s.%s.' % (table.name, column.name))
+                db.engine.execute('ALTER TABLE %s ADD COLUMN %s %s' %
+                                  (table.name, column.name, column.type.compile(dialect=db.engine.dialect)))
+
+
+def track_cached_files(db):
+    add_missing_columns(db)
+    create_missing_indexes(db)
+    now = datetime.now()
+    for cached_file in CachedFile.get_all():
+        path = app.config['CACHE_DIR'] + cached_file.filename
+        cached_file.size = os.path.getsize(path) if os.path.isfile(path) else 0
+        cached_file.created_at = cached_file.accessed_at = now
+    commit()
+
+
+def rebuild_table(db, table):
+    """Recreates the table with its current definition keeping its rows.
+        Needed in SQLite to drop constraints."""
+    old_name = table.name + '_old'
+    columns = ', '.join(column.name for column in table.columns)
+    db.engine.execute('ALTER TABLE %s RENAME TO %s' % (table.name, old_name))
+    for index in inspect(db.engine).get_indexes(old_name):
+        db.engine.execute('DROP INDEX %s' % index['name'])  # To recreate them in the new table
+    table.create(bind=db.engine)
+    db.engine.execute('INSERT INTO %s (%s) SELECT %s FROM %s' % (table.name, columns, columns, old_name))
+    db.engine.execute('DROP TABLE %s' % old_name)
+
+
+def share_cached_files(db):
+    add_missing_columns(db)
+    unique_filenames = [constraint for constraint in inspect(db.engine).get_unique_constraints(CachedFile.__tablename__)
+                        if constraint['column_names'] == ['filename']]
+    if unique_filenames:
+        if db.engine.dialect.name == 'sqlite':
+            rebuild_table(db, CachedFile.__table__)
+        else:
+            db.engine.execute('ALTER TABLE %s DROP CONSTRAINT %s' %
+                              (CachedFile.__tablename__, unique_filenames[0]['name']))
+    create_missing_indexes(db)
+
+
+def validate_cached_files(db):
+    add_missing_columns(db)
+    for cached_file in CachedFile.get_all():
+        cached_file.validated_at = cached_file.created_at
+    commit()
+
+
+# (version, description, function which receives the database)
+MIGRATIONS = (
+    (1, 'Indexes for the most frequent queries', create_missing_indexes),
+    (2, 'Size and access time of the cached files', track_cached_files),
+    (3, 'Cached files shared by several URLs', share_cached_files),
+    (4, 'Validators of the cached files', validate_cached_files),
+)
+
+
+def get_latest_version():
+    return MIGRATIONS[-1][0]
+
+
+def stamp(db):
+    """Marks a newly created database as up to date."""
+    SchemaVersion.set(get_latest_version())
+
+
+def upgrade(db):
+    """Applies the migrations which are missing in the database."""
+    db.create_all()  # Tables which did not exist yet (e.g., 'schema_version')
+    current = SchemaVersion.get()
+    for version, description, migrate in MIGRATIONS:
+        if version > current:
+            logger.info('Migrating database to version %d: %s.' % (version, description))
+            migrate(db)
+            SchemaVersion.set(version)
+    return SchemaVersion.get()
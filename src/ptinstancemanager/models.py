@@ -4,16 +4,52 @@ Created on 13/07/2015
 @author: Aitor Gomez Goiri <aitor.gomez-goiri@open.ac.uk>
 """
 
-from datetime import datetime
+from datetime import datetime, timedelta
+from contextlib import contextmanager
+from sqlalchemy import func
+from sqlalchemy.orm import joinedload
 from sqlalchemy.types import NullType
-from ptinstancemanager.app import db
+from ptinstancemanager.app import app, db
+
+
+def commit():
+    """Commits the changes unless they are part of a unit of work."""
+    if db.session().info.get('unit_of_work'):
+        db.session.flush()  # Just to get the new identifiers
+    else:
+        db.session.commit()
+
+
+@contextmanager
+def unit_of_work():
+    """Commits the changes made by the model within this block in a single transaction.
+
+    If anything fails, none of them is stored.
+    """
+    session = db.session()
+    nested = session.info.get('unit_of_work', False)
+    session.info['unit_of_work'] = True
+    try:
+        yield
+        if not nested:
+            session.commit()
+    except:
+        if not nested:
+            session.rollback()
+        raise
+    finally:
+        session.info['unit_of_work'] = nested
+
 
 
 class Allocation(db.Model):
     __tablename__ = 'allocation'
     id = db.Column(db.Integer, primary_key=True, autoincrement=True)
     created_at = db.Column(db.DateTime, default=datetime.now)
-    deleted_at = db.Column(db.DateTime)
+    deleted_at = db.Column(db.DateTime, index=True)
+    # Only the instance currently allocated: deallocated ones no longer point to it.
+    instance = db.relationship('Instance', uselist=False, viewonly=True,
+                               primaryjoin='Allocation.id == foreign(Instance.allocated_by)')
 
     def __repr__(self):
         return '<Allocation %r>' % self.id
@@ -26,13 +62,13 @@ class Allocation(db.Model):
 
     def delete(self):
         self.deleted_at = datetime.now()  # set deletion time
-        db.session.commit()
+        commit()
 
     def serialize(self, url, local_machine):
         """Return object data in easily serializeable format"""
         pt_value = None
         if self.is_active():
-            el = Instance.get_by_allocation_id(self.id)
+            el = self.instance
             if el:
                 pt_value = "%s:%d" % (local_machine, el.pt_port)
         return {
@@ -47,24 +83,33 @@ class Allocation(db.Model):
     def create():
         allocation = Allocation()
         db.session.add(allocation)
-        db.session.commit()
+        commit()
         return allocation
 
     @staticmethod
     def get(allocation_id):
         return db.session.query(Allocation).filter_by(id=allocation_id).first()
 
+    @staticmethod
+    def query_with_instances():
+        # Load the instances in the same query to serialize them.
+        return db.session.query(Allocation).options(joinedload(Allocation.instance))
+
+    @staticmethod
+    def get_many(allocation_ids):
+        return Allocation.query_with_instances().filter(Allocation.id.in_(allocation_ids)).all()
+
     @staticmethod
     def get_all():
-        return db.session.query(Allocation).all()
+        return Allocation.query_with_instances()
 
     @staticmethod
     def get_current():
-        return db.session.query(Allocation).filter_by(deleted_at = None)
+        return Allocation.query_with_instances().filter_by(deleted_at = None)
 
     @staticmethod
     def get_finished():
-        return db.session.query(Allocation).filter(Allocation.deleted_at != None).all()
+        return Allocation.query_with_instances().filter(Allocation.deleted_at != None)
 
 
 class Instance(db.Model):
@@ -74,13 +119,22 @@ class Instance(db.Model):
     NONE = -1
     __tablename__ = 'instance'
     id = db.Column(db.Integer, primary_key=True, autoincrement=True)
-    docker_id = db.Column(db.String)
+    docker_id = db.Column(db.String, index=True)
     pt_port = db.Column(db.Integer)
     vnc_port = db.Column(db.Integer)
     created_at = db.Column(db.DateTime, default=datetime.now)
     deleted_at = db.Column(db.DateTime)
-    allocated_by = db.Column(db.Integer, default=NONE)
+    allocated_by = db.Column(db.Integer, default=NONE, index=True)
     status = db.Column(db.Integer, default=STARTING)
+    # Finished instances are the majority and they are rarely queried, so leave them out.
+    __table_args__ = (
+        # get_deallocated()
+        db.Index('ix_instance_active_allocated_by_status', allocated_by, status,
+                 postgresql_where=deleted_at.is_(None), sqlite_where=deleted_at.is_(None)),
+        # get_starting() and get_erroneous()
+        db.Index('ix_instance_active_status', status,
+                 postgresql_where=deleted_at.is_(None), sqlite_where=deleted_at.is_(None)),
+    )
 
     def __init__(self, docker_id, pt_port, vnc_port):
         self.docker_id = docker_id
@@ -104,23 +158,23 @@ class Instance(db.Model):
             # Return already existing one
             return Allocation.get(self.allocated_by)
         else:
-            ret = Allocation.create()
-            self.allocated_by = ret.id
-            db.session.commit()
+            with unit_of_work():
+                ret = Allocation.create()
+                self.allocated_by = ret.id
             return ret
 
     def deallocate(self):
         if self.is_allocated():
-            allocation = Allocation.get(self.allocated_by)
-            allocation.delete()
-            self.allocated_by = Instance.NONE
-            db.session.commit()
+            with unit_of_work():
+                allocation = Allocation.get(self.allocated_by)
+                allocation.delete()
+                self.allocated_by = Instance.NONE
 
     def __set_status(self, new_status):
         # Write it only if needed
         if self.status != new_status:
             self.status = new_status
-            db.session.commit()
+            commit()
 
     def mark_starting(self):
         self.__set_status(Instance.STARTING)
@@ -132,10 +186,19 @@ class Instance(db.Model):
         self.__set_status(Instance.ERROR)
 
     def delete(self):
-        self.deallocate()
-        self.deleted_at = datetime.now()  # set deletion time
-        db.session.commit()
-        Port.get(self.pt_port).release()
+        """Returns False if it had already been deleted (e.g., by the watcher in another process)."""
+        with unit_of_work():
+            # This object might be stale: only the conditional update tells who deletes it.
+            claimed = db.session.query(Instance).filter_by(id=self.id, deleted_at=None).\
+                        update({Instance.deleted_at: datetime.now()}, synchronize_session=False)
+            if claimed != 1:
+                return False
+            db.session.refresh(self)  # E.g., it might have been allocated meanwhile
+            self.deallocate()
+            # Its port might have been given to another instance already.
+            db.session.query(Port).filter_by(instance_id=self.id).\
+                update({Port.instance_id: Port.UNASSIGNED}, synchronize_session=False)
+        return True
 
     def get_id(self):
         return self.id
@@ -168,24 +231,95 @@ class Instance(db.Model):
     def create(docker_id=None, pt_port=None, vnc_port=None):
         instance = Instance(docker_id, pt_port, vnc_port)
         db.session.add(instance)
-        db.session.commit()
+        commit()
         return instance
 
+    @staticmethod
+    def allocate_many(instances):
+        """Allocates the given instances in a single transaction.
+            Returns the allocated instances (others might have been allocated meanwhile)."""
+        allocated = []
+        for instance in instances:
+            allocation = Allocation()
+            db.session.add(allocation)
+            db.session.flush()  # To get its id
+            # The instance might have been allocated or deleted (e.g., by a pool shrink) meanwhile.
+            claimed = db.session.query(Instance).\
+                        filter_by(id=instance.id, allocated_by=Instance.NONE,
+                                  deleted_at=None, status=Instance.READY).\
+                        update({Instance.allocated_by: allocation.id}, synchronize_session=False)
+            if claimed:
+                allocated.append(instance)
+            else:
+                db.session.delete(allocation)
+        commit()
+        return allocated
+
+    @staticmethod
+    def delete_many(instances, deallocated_only=False):
+        """Deletes the given instances in a single transaction (see delete()).
+            If deallocated_only is set, the ones allocated meanwhile are not deleted.
+            Returns the identifiers of the ones deleted (others might have been deleted meanwhile)."""
+        instance_ids = [instance.id for instance in instances]
+        if not instance_ids:
+            return []
+        now = datetime.now()
+        with unit_of_work():
+            # These objects might be stale: only the conditional update tells who deletes each one.
+            to_claim = db.session.query(Instance).\
+                        filter(Instance.id.in_(instance_ids), Instance.deleted_at == None)
+            if deallocated_only:
+                to_claim = to_claim.filter(Instance.allocated_by == Instance.NONE)
+            claimed = to_claim.update({Instance.deleted_at: now}, synchronize_session=False)
+            if claimed == len(instance_ids):
+                claimed_ids = instance_ids
+            elif claimed:
+                # The rows updated by this transaction are the ones with its deletion time.
+                claimed_ids = [row[0] for row in db.session.query(Instance.id).
+                                    filter(Instance.id.in_(instance_ids), Instance.deleted_at == now)]
+            else:
+                return []
+
+            # Read again: they might have been allocated meanwhile.
+            allocation_ids = [row[0] for row in db.session.query(Instance.allocated_by).
+                                filter(Instance.id.in_(claimed_ids), Instance.allocated_by != Instance.NONE)]
+            if allocation_ids:
+                db.session.query(Allocation).filter(Allocation.id.in_(allocation_ids)).\
+                    update({Allocation.deleted_at: now}, synchronize_session=False)
+                db.session.query(Instance).filter(Instance.id.in_(claimed_ids)).\
+                    update({Instance.allocated_by: Instance.NONE}, synchronize_session=False)
+            # Their ports might have been given to other instances already.
+            db.session.query(Port).filter(Port.instance_id.in_(claimed_ids)).\
+                update({Port.instance_id: Port.UNASSIGNED}, synchronize_session=False)
+        return claimed_ids
+
     @staticmethod
     def get(instance_id):
         return db.session.query(Instance).filter_by(id = instance_id).first()
 
+    @staticmethod
+    def get_many(instance_ids):
+        if not instance_ids:
+            return []
+        return db.session.query(Instance).filter(Instance.id.in_(instance_ids)).all()
+
     @staticmethod
     def get_by_docker_id(docker_id):
         return db.session.query(Instance).filter_by(docker_id = docker_id).first()
 
+    @staticmethod
+    def get_by_docker_ids(docker_ids):
+        if not docker_ids:
+            return []
+        return db.session.query(Instance).filter(Instance.docker_id.in_(docker_ids)).all()
+
     @staticmethod
     def get_by_allocation_id(allocation_id):
         return db.session.query(Instance).filter_by(allocated_by = allocation_id).first()
 
     @staticmethod
     def get_all():
-        return db.session.query(Instance).all()
+        return db.session.query(Instance)
 
     @staticmethod
     def get_running():
@@ -193,7 +327,7 @@ class Instance(db.Model):
 
     @staticmethod
     def get_finished():
-        return db.session.query(Instance).filter(Instance.deleted_at != None).all()
+        return db.session.query(Instance).filter(Instance.deleted_at != None)
 
     @staticmethod
     def get_erroneous():
@@ -215,6 +349,26 @@ class Instance(db.Model):
     def get_allocated():
         return db.session.query(Instance).filter(Instance.deleted_at == None, Instance.allocated_by != Instance.NONE)
 
+    @staticmethod
+    def count_by_status():
+        """Returns how many active instances there are in each status."""
+        allocated = Instance.allocated_by != Instance.NONE
+        counts = dict.fromkeys(('starting', 'ready', 'allocated', 'error'), 0)
+        rows = db.session.query(Instance.status, allocated, func.count(Instance.id)).\
+                filter(Instance.deleted_at == None).\
+                group_by(Instance.status, allocated)
+        for status, is_allocated, count in rows:
+            # Same precedence as get_status()
+            if status == Instance.ERROR:
+                counts['error'] += count
+            elif status == Instance.STARTING:
+                counts['starting'] += count
+            elif is_allocated:
+                counts['allocated'] += count
+            else:
+                counts['ready'] += count
+        return counts
+
 
 
 class Port(db.Model):
@@ -223,7 +377,7 @@ class Port(db.Model):
     __tablename__ = 'port'
     number = db.Column(db.Integer, primary_key=True, autoincrement=False)
     # not using db.relationship intentionally. I don't want to keep the other reference.
-    instance_id = db.Column(db.Integer, default=UNASSIGNED)
+    instance_id = db.Column(db.Integer, default=UNASSIGNED, index=True)
 
     def __init__(self, port_number):
         self.number = port_number
@@ -237,14 +391,19 @@ class Port(db.Model):
     def __set_used_by(self, instance_id=None):
         self.instance_id = instance_id if instance_id else Port.UNASSIGNED
 
+    @property
+    def vnc_number(self):
+        """VNC port paired with this one (reserved along with it)."""
+        return self.number + app.config['VNC_PORT_OFFSET']
+
     def assign(self, assigned_instance_id):
         assert assigned_instance_id not in (None, Port.UNASSIGNED, Port.ALLOCATED)
         self.__set_used_by(assigned_instance_id)
-        db.session.commit()
+        commit()
 
     def release(self):
         self.__set_used_by(None)
-        db.session.commit()
+        commit()
 
     @property
     def serialize(self):
@@ -272,23 +431,49 @@ class Port(db.Model):
 
     @staticmethod
     def allocate():
-        allocated_port = Port.get_available().first()
-        if allocated_port is not None:
-            allocated_port.__set_used_by(Port.ALLOCATED)
+        """Reserves an available port (and its paired VNC port)."""
+        while True:
+            candidate = db.session.query(Port.number).filter_by(instance_id=Port.UNASSIGNED).limit(1).scalar()
+            if candidate is None:
+                return None
+            # Concurrent workers might have picked the same candidate.
+            # The conditional update only succeeds for one of them.
+            claimed = db.session.query(Port).\
+                        filter_by(number=candidate, instance_id=Port.UNASSIGNED).\
+                        update({Port.instance_id: Port.ALLOCATED}, synchronize_session=False)
+            # Other workers must see the claim right away, so it is always
+            # committed. Therefore, do not call it within a unit of work.
             db.session.commit()
-        return allocated_port
+            if claimed:
+                return Port.get(candidate)
+            # Someone else got it, try with the next available one.
 
 
 
 class CachedFile(db.Model):
+    # Accesses closer in time than this are not written (to avoid a commit per access).
+    ACCESS_RESOLUTION = timedelta(minutes=1)
     __tablename__ = 'cached'
     id = db.Column(db.Integer, primary_key=True, autoincrement=True)
     url = db.Column(db.String, index=True, unique=True)
-    filename = db.Column(db.String, unique=True)
-
-    def __init__(self, url, local_filename):
+    # Shared by the URLs with the same content
+    filename = db.Column(db.String, index=True)
+    size = db.Column(db.Integer, default=0)  # In bytes
+    created_at = db.Column(db.DateTime, default=datetime.now)
+    accessed_at = db.Column(db.DateTime, default=datetime.now, index=True)
+    # Validators sent by the server (to check later whether the file has changed)
+    etag = db.Column(db.String)
+    last_modified = db.Column(db.String)
+    validated_at = db.Column(db.DateTime, default=datetime.now)
+    max_age = db.Column(db.Integer)  # In seconds. If None, the default one is used.
+
+    def __init__(self, url, local_filename, size=0, etag=None, last_modified=None, max_age=None):
         self.url = url
         self.filename = local_filename
+        self.size = size
+        self.etag = etag
+        self.last_modified = last_modified
+        self.max_age = max_age
 
     def __repr__(self):
         return '<CachedFile %r: %r>' % (self.url, self.filename)
@@ -303,25 +488,101 @@ class CachedFile(db.Model):
             'filename': container_mount_dir + self.filename
        }
 
+    def touch(self):
+        """Records that the file has been accessed."""
+        now = datetime.now()
+        if self.accessed_at is None or now - self.accessed_at > CachedFile.ACCESS_RESOLUTION:
+            self.accessed_at = now
+            commit()
+
+    def is_stale(self, default_max_age):
+        """Should it be checked whether the file has changed in the server?"""
+        max_age = self.max_age if self.max_age is not None else default_max_age
+        if not max_age:  # Valid forever
+            return False
+        return self.validated_at is None or datetime.now() - self.validated_at > timedelta(seconds=max_age)
+
+    def mark_validated(self):
+        self.validated_at = datetime.now()
+        commit()
+
+    def update(self, local_filename, size, etag, last_modified):
+        self.filename = local_filename
+        self.size = size
+        self.etag = etag
+        self.last_modified = last_modified
+        self.mark_validated()
+
     @staticmethod
-    def create(url, local_filename):
-        cached_file = CachedFile(url, local_filename)
+    def create(url, local_filename, size=0, etag=None, last_modified=None, max_age=None):
+        cached_file = CachedFile(url, local_filename, size, etag, last_modified, max_age)
         db.session.add(cached_file)
-        db.session.commit()
+        commit()
         return cached_file
 
+    @staticmethod
+    def create_many(cached_files):
+        """Inserts all of them at once (the objects are not added to the session)."""
+        db.session.bulk_save_objects(cached_files)
+        commit()
+
     @staticmethod
     def get(url):
         return db.session.query(CachedFile).filter_by(url=url).first()
 
+    @staticmethod
+    def get_many(urls):
+        if not urls:
+            return []
+        return db.session.query(CachedFile).filter(CachedFile.url.in_(urls)).all()
+
     @staticmethod
     def get_all():
         return db.session.query(CachedFile).all()
 
+    @staticmethod
+    def get_least_recently_used():
+        return db.session.query(CachedFile).order_by(CachedFile.accessed_at.asc())
+
+    @staticmethod
+    def get_count():
+        return db.session.query(CachedFile).count()
+
+    @staticmethod
+    def count_by_filename(filename):
+        return db.session.query(CachedFile).filter_by(filename=filename).count()
+
+    @staticmethod
+    def get_total_size():
+        # Files shared by several URLs only count once.
+        stored = db.session.query(CachedFile.filename, CachedFile.size).distinct().subquery()
+        return db.session.query(func.coalesce(func.sum(stored.c.size), 0)).scalar()
+
     @staticmethod
     def delete(cached_file):
         db.session.delete(cached_file)
-        db.session.commit()
+        commit()
+
+
+
+class SchemaVersion(db.Model):
+    """Last migration applied to the database (see the migrations module)."""
+    __tablename__ = 'schema_version'
+    version = db.Column(db.Integer, primary_key=True, autoincrement=False)
+
+    def __init__(self, version):
+        self.version = version
+
+    @staticmethod
+    def get():
+        current = db.session.query(SchemaVersion).first()
+        return current.version if current else 0
+
+    @staticmethod
+    def set(version):
+        db.session.query(SchemaVersion).delete()
+        db.session.add(SchemaVersion(version))
+        commit()
 
 
 
@@ -329,4 +590,4 @@ def init_database(dbase, lowest_port, highest_port):
     for port_number in range(lowest_port, highest_port+1):
         available_port = Port(port_number)
         db.session.add(available_port)
-    db.session.commit()
+    commit()
@@ -0,0 +1,55 @@
+"""
+Created on 16/10/2026
+
+Counters of the warm pool of deallocated instances.
+
+They are stored in Redis because allocations happen in the workers
+while they are read from the web application.
+"""
+
+import time
+from datetime import datetime
+from ptinstancemanager.app import app, redis_store
+
+
+POOL_KEY = 'ptinstancemanager:pool'
+
+
+def record_hit(count=1):
+    """An allocation was served by an already running instance."""
+    redis_store.hincrby(POOL_KEY, 'hits', count)
+
+
+def record_miss(count=1):
+    """An allocation had to wait for a new instance to be created."""
+    redis_store.hincrby(POOL_KEY, 'misses', count)
+
+
+def record_refill(created):
+    pipe = redis_store.pipeline()
+    pipe.hincrby(POOL_KEY, 'created', created)
+    pipe.hset(POOL_KEY, 'last_refill', time.time())
+    pipe.execute()
+
+
+def record_shrink(removed):
+    redis_store.hincrby(POOL_KEY, 'removed', removed)
+
+
+def get_stats():
+    stored = redis_store.hgetall(POOL_KEY)
+    hits = int(stored.get('hits', 0))
+    misses = int(stored.get('misses', 0))
+    last_refill = stored.get('last_refill')
+    return {
+        'minIdle': app.config['POOL_MIN_IDLE'],
+        'maxIdle': app.config['POOL_MAX_IDLE'],
+        'refillRate': app.config['POOL_REFILL_RATE'],
+        'checkInterval': app.config['POOL_CHECK_INTERVAL'],
+        'hits': hits,
+        'misses': misses,
+        'hitRate': float(hits) / (hits + misses) if hits + misses else None,
+        'created': int(stored.get('created', 0)),
+        'removed': int(stored.get('removed', 0)),
+        'lastRefill': datetime.fromtimestamp(float(last_refill)).isoformat() if last_refill else None
+    }
@@ -0,0 +1,109 @@
+"""
+Created on 16/10/2026
+
+Checks whether Packet Tracer instances answer in their IPC ports.
+
+Two backends are available:
+ * 'socket' probes the ports from this process, several of them at once.
+ * 'jar' runs the JPTChecker (a JVM per check).
+With the simulated Docker backend, the simulated containers are asked instead.
+
+Docker accepts connections in the published ports even when nothing listens
+inside the container, closing them right afterwards. Therefore, the 'socket'
+backend considers that Packet Tracer is ready when the connection is accepted
+and it is not closed during a short quiet period.
+"""
+
+import time
+import errno
+import select
+import socket
+import ptchecker
+from multiprocessing.pool import ThreadPool
+from ptinstancemanager import simulation
+from ptinstancemanager.app import app
+
+
+def probe_many(host, ports, timeout):
+    """Returns the subset of ports where Packet Tracer is listening."""
+    connecting = {}  # By file descriptor
+    for port in ports:
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        sock.setblocking(0)
+        if sock.connect_ex((host, port)) in (0, errno.EINPROGRESS, errno.EWOULDBLOCK):
+            connecting[sock.fileno()] = (sock, port)
+        else:
+            sock.close()  # E.g., connection refused
+
+    # Unlike select(), poll() accepts any number of descriptors.
+    connected = {}
+    try:
+        poller = select.poll()
+        for fd in connecting:
+            poller.register(fd, select.POLLOUT)
+        deadline = time.time() + timeout
+        while connecting:
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                break
+            for fd, _ in poller.poll(remaining * 1000):
+                poller.unregister(fd)
+                sock, port = connecting.pop(fd)
+                if sock.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR) == 0:
+                    connected[fd] = (sock, port)
+                else:
+                    sock.close()
+
+        ready = set(port for _, port in connected.values())
+        poller = select.poll()
+        for fd in connected:
+            poller.register(fd, select.POLLIN)
+        deadline = time.time() + app.config['PT_CHECKER_QUIET_PERIOD']
+        while connected:
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                break
+            events = poller.poll(remaining * 1000)
+            if not events:
+                break
+            for fd, _ in events:
+                poller.unregister(fd)
+                sock, port = connected.pop(fd)
+                try:
+                    data = sock.recv(1)
+                except socket.error:
+                    data = ''
+                if not data:
+                    ready.discard(port)  # Closed: nobody listens behind Docker's proxy.
+                sock.close()
+        return ready
+    finally:
+        for sock, _ in list(connecting.values()) + list(connected.values()):
+            sock.close()
+
+
+def is_ready(host, port, timeout):
+    """Does the Packet Tracer instance listening in the given port answer?"""
+    if app.config['DOCKER_BACKEND'] == 'simulated':
+        return simulation.get_client().is_ready(port, timeout)
+    if app.config['PT_CHECKER_BACKEND'] == 'jar':
+        return ptchecker.is_running(app.config['PT_CHECKER'], host, port, float(timeout))
+    return port in probe_many(host, (port,), timeout)
+
+
+def get_ready(host, ports, timeout):
+    """Returns the subset of ports where Packet Tracer instances answer.
+        They are checked at the same time, so it takes about timeout seconds at most."""
+    if not ports:
+        return set()
+    if app.config['DOCKER_BACKEND'] == 'simulated':
+        return simulation.get_client().get_ready(ports, timeout)
+    if app.config['PT_CHECKER_BACKEND'] == 'jar':
+        # A JVM per check: do not run more of them than Docker calls at once.
+        checkers = ThreadPool(min(len(ports), app.config['DOCKER_PARALLELISM']))
+        try:
+            answers = checkers.map(lambda port: is_ready(host, port, timeout), ports)
+        finally:
+            checkers.close()
+        return set(port for port, answered in zip(ports, answers) if answered)
+    return probe_many(host, ports, timeout)
@@ -0,0 +1,77 @@
+"""
+Created on 16/10/2026
+
+Background sampling of the CPU and memory used in the machine.
+
+Checking the thresholds must not block: psutil.cpu_percent() needs to wait
+between two measures to be accurate. Instead, a daemon thread measures
+them periodically and smooths them using an exponentially weighted moving
+average (EWMA).
+"""
+
+import os
+import time
+import psutil
+import logging
+import threading
+from ptinstancemanager.app import app
+
+
+logger = logging.getLogger()
+
+
+class ResourceSampler(threading.Thread):
+
+    def __init__(self, interval, smoothing):
+        super(ResourceSampler, self).__init__(name='resource-sampler')
+        self.daemon = True
+        self.interval = interval
+        self.smoothing = smoothing
+        # The first measure blocks, but it gives a meaningful starting point.
+        self.cpu = psutil.cpu_percent(interval=0.1)
+        self.memory = psutil.virtual_memory().percent
+        self.sampled_at = time.time()
+
+    def sample(self):
+        # Percentage since the previous call: it does not block.
+        cpu = psutil.cpu_percent(interval=None)
+        memory = psutil.virtual_memory().percent
+        # Replacing floats is atomic, so readers do not need a lock.
+        self.cpu = self.smoothing * cpu + (1 - self.smoothing) * self.cpu
+        self.memory = self.smoothing * memory + (1 - self.smoothing) * self.memory
+        self.sampled_at = time.time()
+
+    def get_snapshot(self):
+        return {'cpu': self.cpu, 'memory': self.memory, 'sampled_at': self.sampled_at}
+
+    def run(self):
+        while True:
+            time.sleep(self.interval)
+            try:
+                self.sample()
+            except Exception as e:  # Keep sampling no matter what
+                logger.error('Error sampling resources. %s.' % e)
+
+
+# One per process, threads do not survive a fork.
+# They all measure the whole machine, so their snapshots are not shared.
+samplers = {}
+samplers_lock = threading.Lock()
+
+
+def get_sampler():
+    pid = os.getpid()
+    sampler = samplers.get(pid)
+    if sampler is None:
+        with samplers_lock:
+            sampler = samplers.get(pid)
+            if sampler is None:
+                sampler = ResourceSampler(app.config['SAMPLE_INTERVAL'], app.config['SAMPLE_SMOOTHING'])
+                sampler.start()
+                samplers[pid] = sampler
+    return sampler
+
+
+def get_usage():
+    """Returns the latest smoothed percentages of CPU and memory used."""
+    return get_sampler().get_snapshot()
@@ -11,7 +11,7 @@ from argparse import ArgumentParser
 from ptinstancemanager.config import configuration
 
 
-def main(config_file, create_database, port_number):
+def main(config_file, create_database, upgrade_database, port_number):
 	configuration.set_file_path(config_file)
 	from ptinstancemanager.main import load_app, load_db
 	app = load_app()
@@ -21,6 +21,11 @@ def main(config_file, create_database, port_number):
 		db.create_all() # By default it doesn't create already created tables
 		from ptinstancemanager.models import init_database
 		init_database(db, app.config['LOWEST_PORT'], app.config['HIGHEST_PORT'])
+		from ptinstancemanager.migrations import stamp
+		stamp(db)
+	elif upgrade_database:
+		from ptinstancemanager.migrations import upgrade
+		print('Database in version %d.' % upgrade(load_db()))
 	else:
 		# We don't run the app in the database creation mode.
 		# Otherwise on flask's automatic restarts it will try to create the database and data again!
@@ -31,6 +36,8 @@ def entry_point():
 	parser = ArgumentParser(description='Run sample web server which uses ptinstancemanager.')
 	parser.add_argument('-createdb', action='store_true', dest='create_db',
 	                    help='Do you want to create the database? (needed at least the first time)')
+	parser.add_argument('-upgradedb', action='store_true', dest='upgrade_db',
+	                    help='Do you want to upgrade an existing database to the current version?')
 	parser.add_argument('-config', default='../../config.ini', dest='config',
 	                    help='Configuration file.')
 	parser.add_argument('-port', type=int, default=5000, dest='port',
@@ -38,7 +45,7 @@ def entry_point():
 	args = parser.parse_args()
 
 	# Builtin server for development.
-	main(args.config, args.create_db, args.port)
+	main(args.config, args.create_db, args.upgrade_db, args.port)
 
 
 
@@ -0,0 +1,253 @@
+"""
+Created on 16/10/2026
+
+Simulated Docker backend to test the instance manager under load without containers.
+
+SimulatedClient answers the same calls of docker.Client used by the tasks,
+but the containers only exist in the memory of the process. Each call
+takes a configurable time and might fail, and running containers might
+exit after a while.
+
+As the containers are not shared between processes, use it running the
+tasks in a single worker process (or eagerly). The containers watcher
+cannot be used with it.
+"""
+
+import os
+import time
+import uuid
+import random
+import threading
+import requests
+from docker.errors import APIError
+from ptinstancemanager.app import app
+
+
+def api_error(status_code, reason, explanation):
+    response = requests.models.Response()
+    response.status_code = status_code
+    response.reason = reason
+    response._content = explanation
+    return APIError(explanation, response, explanation)
+
+
+class SimulatedContainer(object):
+
+    def __init__(self, image, port_bindings):
+        self.id = uuid.uuid4().hex + uuid.uuid4().hex  # Same length as Docker's
+        self.image = image
+        self.port_bindings = port_bindings
+        self.created_at = time.time()
+        self.started_at = None
+        self.finished_at = None
+        self.exit_at = None
+        self.running = False
+        self.paused = False
+        self.exit_code = 0
+
+    def get_status(self, now):
+        if self.running:
+            return 'Up %d seconds%s' % (now - self.started_at, ' (Paused)' if self.paused else '')
+        if self.finished_at:
+            return 'Exited (%d) %d seconds ago' % (self.exit_code, now - self.finished_at)
+        return 'Created'
+
+    def get_state(self):
+        if self.running:
+            return 'paused' if self.paused else 'running'
+        return 'exited' if self.finished_at else 'created'
+
+
+class SimulatedClient(object):
+    """In-memory replacement of docker.Client."""
+
+    api_version = 'simulated'
+
+    def __init__(self, latencies, boot_time, failure_rate, mean_lifetime, exit_codes, seed=None):
+        self.latencies = latencies
+        self.boot_time = boot_time
+        self.failure_rate = failure_rate
+        self.mean_lifetime = mean_lifetime
+        self.exit_codes = exit_codes
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+        self.containers_by_id = {}
+        self.containers_by_port = {}
+
+    def simulate_call(self, operation):
+        """Waits as long as the operation takes and fails as often as configured."""
+        latency = self.latencies.get(operation, 0)
+        if latency:
+            time.sleep(self.random.uniform(0.5, 1.5) * latency)
+        if self.failure_rate and self.random.random() < self.failure_rate:
+            raise api_error(500, 'Internal Server Error', 'Simulated failure on %s.' % operation)
+
+    def refresh(self, container, now):
+        """Running containers exit once their lifetime has passed."""
+        if container.running and container.exit_at and now >= container.exit_at:
+            container.running = False
+            container.paused = False
+            container.finished_at = container.exit_at
+            container.exit_code = self.random.choice(self.exit_codes)
+
+    def get_container(self, container_id):
+        """Must be called holding the lock."""
+        container = self.containers_by_id.get(container_id)
+        if container is None:
+            raise api_error(404, 'Not Found', 'No such container: %s' % container_id)
+        self.refresh(container, time.time())
+        return container
+
+    def ping(self):
+        return 'OK'
+
+    def close(self):
+        pass
+
+    def create_host_config(self, port_bindings=None, **kwargs):
+        return {'PortBindings': port_bindings or {}}
+
+    def create_container(self, image, host_config=None, **kwargs):
+        self.simulate_call('create')
+        port_bindings = (host_config or {}).get('PortBindings', {})
+        container = SimulatedContainer(image, port_bindings)
+        with self.lock:
+            self.containers_by_id[container.id] = container
+            for host_port in port_bindings.values():
+                self.containers_by_port[host_port] = container
+        return {'Id': container.id, 'Warnings': None}
+
+    def start(self, container):
+        self.simulate_call('start')
+        with self.lock:
+            container = self.get_container(container)
+            if not container.running:
+                container.running = True
+                container.started_at = time.time()
+                container.finished_at = None
+                container.exit_at = None
+                if self.mean_lifetime:
+                    container.exit_at = container.started_at + self.random.expovariate(1.0 / self.mean_lifetime)
+
+    def pause(self, container):
+        self.simulate_call('pause')
+        with self.lock:
+            container = self.get_container(container)
+            if not container.running:
+                raise api_error(500, 'Internal Server Error', 'Container %s is not running' % container.id)
+            if container.paused:
+                raise api_error(500, 'Internal Server Error', 'Container %s is already paused' % container.id)
+            container.paused = True
+
+    def unpause(self, container):
+        self.simulate_call('unpause')
+        with self.lock:
+            container = self.get_container(container)
+            if not container.paused:
+                raise api_error(500, 'Internal Server Error', 'Container %s is not paused' % container.id)
+            container.paused = False
+
+    def remove_container(self, container, force=False, **kwargs):
+        self.simulate_call('remove')
+        with self.lock:
+            container = self.get_container(container)
+            if container.running and not force:
+                raise api_error(409, 'Conflict', 'You cannot remove a running container %s.' % container.id)
+            del self.containers_by_id[container.id]
+            for host_port in container.port_bindings.values():
+                if self.containers_by_port.get(host_port) is container:
+                    del self.containers_by_port[host_port]
+
+    def inspect_container(self, container):
+        with self.lock:
+            container = self.get_container(container)
+            return {
+                'Id': container.id,
+                'Image': container.image,
+                'State': {
+                    'Status': container.get_state(),
+                    'Running': container.running,
+                    'Paused': container.paused,
+                    'ExitCode': container.exit_code
+                }
+            }
+
+    def containers(self, all=False, filters=None, **kwargs):
+        statuses = (filters or {}).get('status')
+        if isinstance(statuses, basestring):
+            statuses = [statuses]
+        now = time.time()
+        listed = []
+        with self.lock:
+            for container in self.containers_by_id.values():
+                self.refresh(container, now)
+                state = container.get_state()
+                # As in Docker, filtering by status includes the stopped ones.
+                if statuses and state not in statuses:
+                    continue
+                if not statuses and not all and not container.running:
+                    continue
+                listed.append({'Id': container.id, 'Image': container.image,
+                               'Status': container.get_status(now), 'Created': int(container.created_at)})
+        return listed
+
+    def events(self, **kwargs):
+        raise api_error(501, 'Not Implemented', 'The simulated backend does not send events.')
+
+    def is_ready(self, port, timeout):
+        """Does Packet Tracer answer in the given port?
+            It waits up to timeout seconds for it to finish booting."""
+        with self.lock:
+            container = self.containers_by_port.get(port)
+            if container is None:
+                return False
+            self.refresh(container, time.time())
+            if not container.running or container.paused:
+                return False
+            remaining = container.started_at + self.boot_time - time.time()
+        if remaining > timeout:
+            time.sleep(timeout)
+            return False
+        time.sleep(max(remaining, 0))
+        return True
+
+    def get_ready(self, ports, timeout):
+        """Returns the subset of ports where Packet Tracer answers.
+            It waits up to timeout seconds for them to finish booting."""
+        now = time.time()
+        booted_at = {}
+        with self.lock:
+            for port in ports:
+                container = self.containers_by_port.get(port)
+                if container is None:
+                    continue
+                self.refresh(container, now)
+                if container.running and not container.paused:
+                    booted_at[port] = container.started_at + self.boot_time
+        ready = set(port for port, booted in booted_at.items() if booted - now <= timeout)
+        if len(ready) < len(ports):
+            time.sleep(timeout)  # Like a check that does not get an answer
+        elif ready:
+            time.sleep(max(max(booted_at[port] for port in ready) - now, 0))
+        return ready
+
+
+clients = {}  # One per process, the containers are not shared.
+clients_lock = threading.Lock()
+
+
+def get_client():
+    pid = os.getpid()
+    client = clients.get(pid)
+    if client is None:
+        with clients_lock:
+            client = clients.get(pid)
+            if client is None:
+                client = SimulatedClient(app.config['SIMULATION_LATENCIES'],
+                                         app.config['SIMULATION_BOOT_TIME'],
+                                         app.config['SIMULATION_FAILURE_RATE'],
+                                         app.config['SIMULATION_MEAN_LIFETIME'],
+                                         app.config['SIMULATION_EXIT_CODES'],
+                                         app.config['SIMULATION_SEED'])
+                clients[pid] = client
+    return client
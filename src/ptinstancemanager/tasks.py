@@ -1,16 +1,20 @@
+import os
 import re
-import psutil
+import time
 import logging
+import threading
 from functools import wraps
+from multiprocessing.pool import ThreadPool
 
 from docker import Client
 from docker.errors import APIError
+from requests.exceptions import ConnectionError
 from celery import chain
 from celery.exceptions import MaxRetriesExceededError
 
-import ptchecker
+from ptinstancemanager import filecache, metrics, pool, readiness, resources, simulation, tracing
 from ptinstancemanager.app import app, celery
-from ptinstancemanager.models import Instance, Port, CachedFile
+from ptinstancemanager.models import Instance, Port, CachedFile, unit_of_work
 from ptinstancemanager.exceptions import InsufficientResourcesError, DockerContainerError
 
 
@@ -18,31 +22,53 @@ from ptinstancemanager.exceptions import InsufficientResourcesError, DockerConta
 logger = logging.getLogger()
 
 
+def check_resources(check=('cpu', 'memory')):
+    """Raises InsufficientResourcesError if the machine has reached the CPU or memory thresholds."""
+    usage = resources.get_usage()  # Sampled in the background, it does not block.
+    if 'memory' in check:
+        max_memory = app.config['MAXIMUM_MEMORY']
+        current = usage['memory']
+        if current >= max_memory:
+            raise InsufficientResourcesError('Operation cancelled: not enough Memory. Currently using: %.2f%%.' % current)
+
+    if 'cpu' in check:
+        max_cpu = app.config['MAXIMUM_CPU']
+        current = usage['cpu']
+        if current >= max_cpu:
+            raise InsufficientResourcesError('Operation cancelled: not enough CPU. Currently using: %.2f%%.' % current)
+
+
 def cancellable(check=('cpu', 'memory')):
     def cancellable_decorator(func):
         @wraps(func)
         def has_enough_resources(*args, **kwargs):
             """Has the machine reached the CPU consumption threshold?"""
-            if 'memory' in check:
-                max_memory = app.config['MAXIMUM_MEMORY']
-                current = psutil.virtual_memory().percent
-                if current >= max_memory:
-                    raise InsufficientResourcesError('Operation cancelled: not enough Memory. Currently using: %.2f%%.' % current)
-
-            if 'cpu' in check:
-                max_cpu = app.config['MAXIMUM_CPU']
-                # It is recommended for accuracy that this function be called
-                # with at least 0.1 seconds between calls.
-                current = psutil.cpu_percent(interval=0.1)  #  Blocked during 0.1 secs
-                if current >= max_cpu:
-                    raise InsufficientResourcesError('Operation cancelled: not enough CPU. Currently using: %.2f%%.' % current)
-
+            with tracing.span('check_resources'):
+                check_resources(check)
             logger.info('All the thresholds were passed.')
             return func(*args, **kwargs)
         return has_enough_resources
     return cancellable_decorator
 
 
+def run_concurrently(func, args):
+    """Calls func once per argument using a bounded number of threads.
+        Returns the exception raised by each call (None if it succeeded)."""
+    def call(arg):
+        try:
+            func(arg)
+            return None
+        except Exception as e:
+            return e
+    if not args:
+        return []
+    workers = ThreadPool(min(len(args), app.config['DOCKER_PARALLELISM']))
+    try:
+        return workers.map(call, args)
+    finally:
+        workers.close()
+
+
 def create_instances(num_containers):
     logger.info('Creating new containers.')
     for _ in range(num_containers):
@@ -56,8 +82,65 @@ def allocate_port():
     return available_port
 
 
+class PooledClient(Client):
+    """Docker client which recovers from broken connections.
+
+    The client keeps its connections to the daemon open between calls.
+    If the daemon has been restarted meanwhile, they are dropped so the
+    next call reconnects.
+    """
+
+    def request(self, method, url, *args, **kwargs):
+        try:
+            return super(PooledClient, self).request(method, url, *args, **kwargs)
+        except ConnectionError:
+            self.close()  # Drop pooled connections
+            if method.upper() != 'GET':
+                raise
+            # Only reads are safe to be repeated.
+            return super(PooledClient, self).request(method, url, *args, **kwargs)
+
+
+# Clients are neither shared between threads nor between forked processes.
+docker_clients = threading.local()
+# Negotiated once per process instead of once per client.
+docker_api_version = app.config['DOCKER_API_VERSION']
+
+
+def create_docker_client():
+    global docker_api_version
+    client = PooledClient(app.config['DOCKER_URL'], version=docker_api_version)
+    docker_api_version = client.api_version
+    docker_clients.client = client
+    docker_clients.pid = os.getpid()
+    return client
+
+
+def is_healthy(client):
+    try:
+        client.ping()
+        return True
+    except (APIError, ConnectionError) as e:
+        logger.warning('Discarding Docker client. %s.' % e)
+        return False
+
+
 def get_docker_client():
-    return Client(app.config['DOCKER_URL'], version='auto')
+    """Returns the Docker client of the current thread.
+
+    Clients unused for a while are checked first and replaced if they do not answer.
+    """
+    if app.config['DOCKER_BACKEND'] == 'simulated':
+        return simulation.get_client()
+    client = getattr(docker_clients, 'client', None)
+    now = time.time()
+    if client is None or docker_clients.pid != os.getpid():
+        client = create_docker_client()
+    elif now - docker_clients.last_used > app.config['DOCKER_HEALTH_CHECK'] and not is_healthy(client):
+        client.close()
+        client = create_docker_client()
+    docker_clients.last_used = now
+    return client
 
 
 #@celery.task()
@@ -87,56 +170,106 @@ def start_container(pt_port, vnc_port):
 
 
 @celery.task()
-def create_instance():
+@metrics.timed('create_instance')
+def create_instance(allocate=False):
     """Runs a new packettracer container in the specified port and
-        create associated instance."""
+        create associated instance (allocated if requested)."""
     logger.info('Creating new container.')
-    pt_port = allocate_port()
-    vnc_port_number = pt_port.number + 10000
+    # Claimed on its own transaction: it cannot wait for the container to start.
+    with tracing.span('allocate_port'):
+        pt_port = allocate_port()
+    vnc_port_number = pt_port.vnc_number
     try:
-        container_id = start_container(pt_port.number, vnc_port_number)
+        with tracing.span('start_container'):
+            container_id = start_container(pt_port.number, vnc_port_number)
         logger.info('Container started: %s' % container_id)
 
         # If success...
-        instance = Instance.create(container_id, pt_port.number, vnc_port_number)
-        pt_port.assign(instance.id)
+        with tracing.span('create_commit'), unit_of_work():
+            instance = Instance.create(container_id, pt_port.number, vnc_port_number)
+            pt_port.assign(instance.id)
+            if allocate:
+                instance.allocate()
 
         wait_for_ready_container.s(instance.id).delay()
         return instance.id
-    except DockerContainerError as e:
+    except (DockerContainerError, APIError) as e:
         pt_port.release()
         raise e
 
 
 @celery.task(expires=app.config['CELERY_TASK_EXPIRATION'])
+@tracing.traced
+@metrics.timed('allocate_instance')
 @cancellable()
 #@cancellable(check=('cpu',))  # Check only the CPU threshold
 def allocate_instance():
     """Unpauses available container and marks associated instance as allocated."""
     logger.info('Allocating instance.')
-    docker = get_docker_client()
+    with tracing.span('docker_client'):
+        docker = get_docker_client()
 
     error_discovered = False
     allocation_id = None
-    for instance in Instance.get_deallocated():
+    with tracing.span('get_deallocated'):
+        # The ones still starting are not paused yet.
+        candidates = Instance.get_deallocated().filter(Instance.status == Instance.READY).all()
+    for instance in candidates:
+        # Claimed before unpausing it: it might have been allocated or deleted meanwhile.
+        with tracing.span('allocate_commit'):
+            if not Instance.allocate_many([instance]):
+                continue
         try:
-            docker.unpause(instance.docker_id)
-            allocation_id = instance.allocate().id
+            with tracing.span('docker_unpause'):
+                docker.unpause(instance.docker_id)
+            allocation_id = instance.allocated_by
+            pool.record_hit()
             break
         except APIError as ae:
             logger.error('Error allocating instance %s.' % instance.id)
             logger.error('Docker API exception. %s.' % ae)
             # e.g., if it was already unpaused or it has been stopped
+            instance.deallocate()
             instance.mark_error()
 
     if not allocation_id:
         # If there were no instances available, consider the creation of a new one
-        instance_id = create_instance.s()()  # Execute task inline
-        allocation_id = Instance.get(instance_id).allocate().id
+        pool.record_miss()
+        with tracing.span('create_instance'):
+            instance_id = create_instance.s(allocate=True)()  # Execute task inline
+        allocation_id = Instance.get(instance_id).allocated_by
 
     return allocation_id
 
 
+@celery.task(expires=app.config['CELERY_TASK_EXPIRATION'])
+@cancellable()
+def allocate_instances(count):
+    """Allocates up to count instances from the pool at once.
+        Returns the identifiers of the allocations created (maybe less than requested)."""
+    logger.info('Allocating %d instances.' % count)
+    candidates = Instance.get_deallocated().filter(Instance.status == Instance.READY).limit(count).all()
+    allocated = Instance.allocate_many(candidates)
+
+    # Sessions cannot be used from other threads, so only pass them the ids.
+    docker_ids = [instance.docker_id for instance in allocated]
+    errors = run_concurrently(lambda docker_id: get_docker_client().unpause(docker_id), docker_ids)
+    allocation_ids = []
+    for instance, error in zip(allocated, errors):
+        if error is None:
+            allocation_ids.append(instance.allocated_by)
+        else:
+            logger.error('Error allocating instance %s.' % instance.id)
+            logger.error('Docker API exception. %s.' % error)
+            instance.deallocate()
+            instance.mark_error()
+    pool.record_hit(len(allocation_ids))
+    # The caller queues the creation of the missing ones, so this task does not wait for them.
+    if len(allocation_ids) < count:
+        pool.record_miss(count - len(allocation_ids))
+    return allocation_ids
+
+
 @celery.task()
 def deallocate_instance(instance_id):
     """Marks instance as deallocated and pauses the associated container."""
@@ -169,6 +302,7 @@ def is_container_running(container_id):
 @celery.task(max_retries=3, default_retry_delay=10)
 # Once it is ready, the container uses to answer in less than 200 ms.
 # Therefore a timeout of 2 seconds should be enough to know whether it is ready.
+@metrics.timed('wait_for_ready_container')
 def wait_for_ready_container(instance_id, timeout=2):
     """Waits for an instance to be ready (e.g., answer).
         Otherwise, marks it as erroneous ."""
@@ -176,7 +310,7 @@ def wait_for_ready_container(instance_id, timeout=2):
     instance = Instance.get(instance_id)
     container_running = is_container_running(instance.docker_id)
     if container_running:
-        is_running = ptchecker.is_running(app.config['PT_CHECKER'], 'localhost', instance.pt_port, float(timeout))
+        is_running = readiness.is_ready('localhost', instance.pt_port, timeout)
         if is_running:
             instance.mark_ready()
             if not instance.is_allocated():
@@ -195,10 +329,71 @@ def wait_for_ready_container(instance_id, timeout=2):
     return instance_id
 
 
+@celery.task()
+def restart_container(instance_id):
+    """Starts again the container of an instance which exited successfully."""
+    instance = Instance.get(instance_id)
+    instance.mark_starting()
+    try:
+        logger.info('Restarting %s.' % instance)
+        get_docker_client().start(container=instance.docker_id)
+        wait_for_ready_container.s(instance.id).delay()
+    except APIError as ae:
+        logger.error('Error restarting container.')
+        logger.error('Docker API exception. %s.' % ae)
+        instance.mark_error()
+    return instance_id
+
+
+@celery.task(max_retries=3, default_retry_delay=10)
+@metrics.timed('wait_for_ready_containers')
+def wait_for_ready_containers(instance_ids, timeout=2):
+    """Waits for several instances to be ready at once (see wait_for_ready_container).
+        The ones which do not answer are checked again together."""
+    logger.info('Waiting for %d containers to be ready.' % len(instance_ids))
+    instances = Instance.get_many(instance_ids)
+    running = set(container.get('Id') for container in
+                  get_docker_client().containers(quiet=True, filters={'status': ['running', 'paused']}))
+    ready_ports = readiness.get_ready('localhost', [instance.pt_port for instance in instances
+                                                    if instance.docker_id in running], timeout)
+    ready = []
+    pending = []
+    with unit_of_work():
+        for instance in instances:
+            if instance.pt_port in ready_ports:
+                instance.mark_ready()
+                ready.append(instance)
+            elif instance.docker_id in running:
+                pending.append(instance)
+            else:
+                # If the container is not even running, PT won't answer.
+                instance.mark_error()
+
+    # Paused here instead of sending a deallocate_instance task for each one.
+    to_pause = [instance for instance in ready if not instance.is_allocated()]
+    errors = run_concurrently(lambda docker_id: get_docker_client().pause(docker_id),
+                              [instance.docker_id for instance in to_pause])
+    with unit_of_work():
+        for instance, error in zip(to_pause, errors):
+            if error is not None:
+                logger.error('Error pausing instance %s.' % instance.id)
+                logger.error('Docker API exception. %s.' % error)
+                instance.mark_error()
+
+    if pending:
+        try:
+            raise wait_for_ready_containers.retry(args=([instance.id for instance in pending], timeout))
+        except MaxRetriesExceededError:
+            with unit_of_work():
+                for instance in pending:
+                    instance.mark_error()
+    return [instance.id for instance in ready]
+
+
 @celery.task()
 def try_restart_on_exited_containers():
     docker = get_docker_client()
-    restarted_instances = []
+    exit_codes = {}
     # 'exited': 0 throws exception, 'exited': '0' does not work.
     # Because of this I have felt forced to use regular expressions :-(
     pattern = re.compile(r"Exited [(](\d+)[)]")
@@ -207,40 +402,96 @@ def try_restart_on_exited_containers():
         if container.get('Image')=='packettracer':
             match = pattern.match(container.get('Status'))
             if match:  # Stopped containers only
-                container_id = container.get('Id')
-                instance = Instance.get_by_docker_id(container_id)
-                if instance:
-                    if match.group(1)=='0':
-                        # Restart stopped containers (which exited successfully)
-                        instance.mark_starting()
-                        try:
-                            logger.info('Restarting %s.' % instance)
-                            docker.start(container=container_id)
-                            wait_for_ready_container.s(instance.id).delay()
-                            restarted_instances.append(instance.id)
-                        except APIError as ae:
-                            logger.error('Error restarting container.')
-                            logger.error('Docker API exception. %s.' % ae)
-                            instance.mark_error()
-                    else:
-                        # TODO Check more thoroughly if containers with other
-                        # type of exit errors could be restarted too.
-                        instance.mark_error()
+                exit_codes[container.get('Id')] = match.group(1)
+
+    to_restart = []
+    with unit_of_work():
+        for instance in Instance.get_by_docker_ids(list(exit_codes)):
+            if exit_codes[instance.docker_id]=='0':
+                # Restart stopped containers (which exited successfully)
+                instance.mark_starting()
+                to_restart.append(instance)
+            else:
+                # TODO Check more thoroughly if containers with other
+                # type of exit errors could be restarted too.
+                instance.mark_error()
+
+    for instance in to_restart:
+        logger.info('Restarting %s.' % instance)
+    errors = run_concurrently(lambda docker_id: get_docker_client().start(container=docker_id),
+                              [instance.docker_id for instance in to_restart])
+    restarted_instances = []
+    with unit_of_work():
+        for instance, error in zip(to_restart, errors):
+            if error is None:
+                restarted_instances.append(instance.id)
+            else:
+                logger.error('Error restarting container.')
+                logger.error('Docker API exception. %s.' % error)
+                instance.mark_error()
+
+    if restarted_instances:
+        # A single task checks all of them instead of one per container.
+        wait_for_ready_containers.s(restarted_instances).delay()
     return restarted_instances
 
 
 @celery.task()
 def delete_erroneous(not_delete=[]):
-    deleted_instances = []
-    for erroneous_instance in Instance.get_erroneous():
-        if erroneous_instance.id not in not_delete:
-            logger.info('Deleting erroneous %s.' % erroneous_instance)
-            erroneous_instance.delete()
-            deleted_instances.append(erroneous_instance.id)
-            # Very conservative approach:
-            #   we remove it even if it might still be usable.
-            remove_container.s(erroneous_instance.docker_id).delay()
-    return deleted_instances
+    erroneous_instances = [instance for instance in Instance.get_erroneous() if instance.id not in not_delete]
+    for erroneous_instance in erroneous_instances:
+        logger.info('Deleting erroneous %s.' % erroneous_instance)
+    # All of them in a single transaction.
+    deleted_ids = set(Instance.delete_many(erroneous_instances))
+    if deleted_ids:
+        # Very conservative approach:
+        #   we remove them even if they might still be usable.
+        remove_containers.s([instance.docker_id for instance in erroneous_instances
+                             if instance.id in deleted_ids]).delay()
+    return [instance.id for instance in erroneous_instances if instance.id in deleted_ids]
+
+
+@celery.task()
+def maintain_pool():
+    """Keeps the number of deallocated (i.e., ready and paused) instances
+        between the configured minimum and maximum."""
+    idle = Instance.get_deallocated().count()
+    if idle < app.config['POOL_MIN_IDLE']:
+        try:
+            check_resources()
+        except InsufficientResourcesError as ire:
+            logger.warning('The pool of instances cannot be refilled. %s' % ire.args[0])
+            return 0
+        # Creation is asynchronous, so do not exceed the available ports
+        # or we would get errors later.
+        to_create = min(app.config['POOL_MIN_IDLE'] - idle,
+                        app.config['POOL_REFILL_RATE'],
+                        Port.get_available().count())
+        if to_create > 0:
+            logger.info('Refilling the pool of instances (%d idle).' % idle)
+            create_instances(to_create)
+            pool.record_refill(to_create)
+        return to_create
+    elif idle > app.config['POOL_MAX_IDLE']:
+        to_remove = idle - app.config['POOL_MAX_IDLE']
+        logger.info('Shrinking the pool of instances (%d idle).' % idle)
+        # The ones which are still starting go first.
+        candidates = Instance.get_deallocated().order_by(None).\
+                        order_by(Instance.status.asc()).limit(to_remove).all()
+        # Some might have been allocated meanwhile: only the ones claimed are removed.
+        removed_ids = set(Instance.delete_many(candidates, deallocated_only=True))
+        if removed_ids:
+            remove_containers.s([instance.docker_id for instance in candidates
+                                 if instance.id in removed_ids]).delay()
+        pool.record_shrink(len(removed_ids))
+        return -len(removed_ids)
+    return 0
+
+
+@celery.task()
+def evict_cached_files():
+    """Keeps the cache of files within its quota."""
+    return filecache.evict()
 
 
 @celery.task()
@@ -250,16 +501,34 @@ def monitor_containers():
     chain(try_restart_on_exited_containers.s(), delete_erroneous.s())()
 
 
+def destroy_container(docker_id):
+    """Removes a container whatever its state is."""
+    docker = get_docker_client()
+    state = docker.inspect_container(docker_id)['State']
+    if state['Paused']:
+        docker.unpause(docker_id)
+    # It might be 'Running' or all to false (exited)
+    docker.remove_container(docker_id, force=True)
+
+
 @celery.task()
+@metrics.timed('remove_container')
 def remove_container(docker_id):
     logger.info('Removing container %s.' % docker_id)
-    docker = get_docker_client()
     try:
-        state = docker.inspect_container(docker_id)['State']
-        if state['Paused']:
-            docker.unpause(docker_id)
-        # It might be 'Running' or all to false (exited)
-        docker.remove_container(docker_id, force=True)
+        destroy_container(docker_id)
     except APIError as ae:
         logger.error('Error on container removal: %s.' % docker_id)
         logger.error('Docker API exception. %s.' % ae)
+
+
+@celery.task()
+@metrics.timed('remove_containers')
+def remove_containers(docker_ids):
+    """Removes several containers with a bounded number of simultaneous calls to Docker."""
+    logger.info('Removing %d containers.' % len(docker_ids))
+    errors = run_concurrently(destroy_container, docker_ids)
+    for docker_id, error in zip(docker_ids, errors):
+        if error is not None:
+            logger.error('Error on container removal: %s.' % docker_id)
+            logger.error('Docker API exception. %s.' % error)
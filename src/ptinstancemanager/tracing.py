@@ -0,0 +1,174 @@
+"""
+Created on 16/10/2026
+
+Timing of the stages of each allocation.
+
+A trace starts when the web application receives the allocation request.
+Its identifier and start time travel to the worker in the headers of the
+Celery task, so the spans measured on both sides share the same origin.
+Each side logs its spans as a JSON record. The traces are also stored in
+Redis for a while, and the slow ones stay listed for the API.
+"""
+
+import json
+import time
+import uuid
+import logging
+import threading
+from functools import wraps
+from contextlib import contextmanager
+from celery.signals import task_prerun
+from redis.exceptions import RedisError
+from ptinstancemanager.app import app, redis_store
+
+
+TRACE_KEY = 'ptinstancemanager:traces:%s'
+SLOW_TRACES_KEY = 'ptinstancemanager:traces:slow'  # Sorted by start time
+TRACE_EXPIRATION = 600  # Seconds that the spans of one side wait for the other one
+
+logger = logging.getLogger()
+
+local = threading.local()
+
+
+class Trace(object):
+
+    def __init__(self, trace_id, process, started=None):
+        self.trace_id = trace_id
+        self.process = process
+        self.started = started or time.time()
+        self.depth = 0
+        self.spans = []
+
+    def add_span(self, name, started, duration, depth=0):
+        self.spans.append({
+            'name': name,
+            'process': self.process,
+            'start': round(started - self.started, 6),
+            'duration': round(duration, 6),
+            'depth': depth
+        })
+
+    def get_headers(self):
+        """Headers to send with the Celery task so that the worker continues the trace."""
+        return {'trace_id': self.trace_id, 'trace_started': self.started}
+
+
+def get_current():
+    return getattr(local, 'trace', None)
+
+
+def start(process, trace_id=None, started=None):
+    """Starts a trace in the current thread."""
+    local.trace = Trace(trace_id or uuid.uuid4().hex, process, started)
+    return local.trace
+
+
+@contextmanager
+def span(name):
+    """Measures the enclosed block (if the thread is being traced)."""
+    trace = get_current()
+    if trace is None:
+        yield
+        return
+    started = time.time()
+    depth = trace.depth
+    trace.depth += 1
+    try:
+        yield
+    finally:
+        trace.depth = depth
+        trace.add_span(name, started, time.time() - started, depth)
+
+
+def finish(allocation_id=None):
+    """Logs the spans of the current trace and stores them.
+
+    Each side merges the spans that the other one might have stored.
+    """
+    trace = local.__dict__.pop('trace', None)
+    if trace is None:
+        return None
+    duration = time.time() - trace.started
+    logger.info('Allocation trace: %s' % json.dumps({
+        'trace': trace.trace_id,
+        'process': trace.process,
+        'allocation': allocation_id,
+        'duration': round(duration, 6),
+        'spans': trace.spans
+    }))
+
+    record = {
+        'id': trace.trace_id,
+        'allocation': allocation_id,
+        'startedAt': trace.started,
+        'duration': round(duration, 6),
+        'spans': sorted(trace.spans, key=lambda s: s['start'])
+    }
+    try:
+        key = TRACE_KEY % trace.trace_id
+        stored = redis_store.get(key)
+        if stored:
+            stored = json.loads(stored)
+            record['allocation'] = record['allocation'] or stored['allocation']
+            record['duration'] = max(record['duration'], stored['duration'])
+            record['spans'] = sorted(trace.spans + stored['spans'], key=lambda s: s['start'])
+        slow = record['duration'] >= app.config['TRACE_SLOW_THRESHOLD']
+        pipe = redis_store.pipeline()
+        pipe.set(key, json.dumps(record), ex=app.config['TRACE_RETENTION'] if slow else TRACE_EXPIRATION)
+        if slow:
+            pipe.zadd(SLOW_TRACES_KEY, {trace.trace_id: trace.started})
+            pipe.zremrangebyscore(SLOW_TRACES_KEY, '-inf', time.time() - app.config['TRACE_RETENTION'])
+        pipe.execute()
+    except RedisError as e:  # Tracing is not worth failing the allocation
+        logger.warning('The trace %s could not be stored. %s' % (trace.trace_id, e))
+    return record
+
+
+def get_header(request, name):
+    value = getattr(request, name, None)  # Headers sent to a worker
+    if value is None and request.headers:  # Eager execution
+        value = request.headers.get(name)
+    return value
+
+
+@task_prerun.connect
+def receive_trace(task=None, **kwargs):
+    # Calling the task pushes a new request without the headers, so they are read before.
+    local.received = (get_header(task.request, 'trace_id'), get_header(task.request, 'trace_started'))
+
+
+def traced(func):
+    """Continues in the worker the trace started by the web application (if any).
+
+    The decorated task must return the allocation identifier.
+    """
+    @wraps(func)
+    def wrapper(*args, **kwargs):
+        trace_id, enqueued = local.__dict__.pop('received', (None, None))
+        if trace_id is None or get_current() is not None:
+            return func(*args, **kwargs)  # Not traced or already traced (inline call)
+        trace = start('worker', trace_id, enqueued)
+        if enqueued:
+            trace.add_span('queued', enqueued, time.time() - enqueued)
+        allocation_id = None
+        try:
+            allocation_id = func(*args, **kwargs)
+            return allocation_id
+        finally:
+            finish(allocation_id)
+    return wrapper
+
+
+def get(trace_id):
+    stored = redis_store.get(TRACE_KEY % trace_id)
+    return json.loads(stored) if stored else None
+
+
+def get_slow(limit):
+    """Returns the latest slow traces (the most recent first)."""
+    trace_ids = redis_store.zrevrange(SLOW_TRACES_KEY, 0, limit - 1)
+    if not trace_ids:
+        return []
+    stored = redis_store.mget([TRACE_KEY % trace_id for trace_id in trace_ids])
+    return [json.loads(trace) for trace in stored if trace]
@@ -4,20 +4,28 @@ Created on 13/07/2015
 @author: Aitor Gomez Goiri <aitor.gomez-goiri@open.ac.uk>
 """
 
-import os
-import errno
-import random
-import string
-import urllib2
+import json
 import logging
 from urlparse import urlparse
-from flask import redirect, request, render_template, url_for, jsonify
-from celery.exceptions import TaskRevokedError
+from datetime import datetime
+from flask import redirect, request, render_template, url_for, jsonify, Response, stream_with_context, \
+                  after_this_request
+from celery import group
+from celery.exceptions import TaskRevokedError, TimeoutError as CeleryTimeoutError
 from werkzeug.exceptions import BadRequest
-from ptinstancemanager import tasks
-from ptinstancemanager.app import app
+from ptinstancemanager import tasks, pool, resources, filecache, metrics, tracing
+from ptinstancemanager.app import app, redis_store
 from ptinstancemanager.models import Allocation, Instance, Port, CachedFile
-from ptinstancemanager.exceptions import InsufficientResourcesError, DockerContainerError
+from ptinstancemanager.exceptions import InsufficientResourcesError, DockerContainerError, FileTooLargeError, \
+                                        DownloadInProgressError
+
+
+logger = logging.getLogger()
+
+# Asynchronous allocation requests issued: Celery reports unknown tasks as pending.
+ALLOCATION_REQUEST_KEY = 'ptinstancemanager:allocation-requests:%s'
+# As long as Celery keeps their results (one day by default).
+ALLOCATION_REQUEST_TTL = 86400
 
 
 @app.route("/")
@@ -54,8 +62,12 @@ def add_header(response):
         response.headers['Link'] += '<%sinstances>; rel="instances"; title="Packet Tracer instances\' management", ' % request.url_root
     if request.path!='/ports':
         response.headers['Link'] += '<%sports>; rel="ports"; title="Ports that can be allocated", ' % request.url_root
+    if request.path!='/pool':
+        response.headers['Link'] += '<%spool>; rel="pool"; title="Pool of instances waiting to be allocated", ' % request.url_root
     if request.path!='/files':
         response.headers['Link'] += '<%sfiles>; rel="files"; title="Cache for Packet Tracer files", ' % request.url_root
+    if request.path!='/metrics':
+        response.headers['Link'] += '<%smetrics>; rel="metrics"; title="Metrics in the Prometheus format", ' % request.url_root
     response.headers['Link'] = response.headers['Link'][:-2]  # Remove last comma and space
     return response
 
@@ -87,19 +99,107 @@ def get_configuration_details():
                     highest_port:
                         type: integer
                         description: maximum port for newly created instances
+                    current_cpu:
+                        type: number
+                        format: float
+                        description: Smoothed percentage of CPU currently used
+                    current_memory:
+                        type: number
+                        format: float
+                        description: Smoothed percentage of memory currently used
     """
+    usage = resources.get_usage()
     return jsonify( maximum_cpu=app.config['MAXIMUM_CPU'],
                     maximum_memory=app.config['MAXIMUM_MEMORY'],
                     lowest_port=app.config['LOWEST_PORT'],
-                    highest_port=app.config['HIGHEST_PORT'] )
+                    highest_port=app.config['HIGHEST_PORT'],
+                    current_cpu=usage['cpu'],
+                    current_memory=usage['memory'] )
 
 
 def get_host():
     return urlparse(request.base_url).hostname
 
+def parse_datetime(value):
+    for date_format in ('%Y-%m-%dT%H:%M:%S.%f', '%Y-%m-%dT%H:%M:%S', '%Y-%m-%d'):
+        try:
+            return datetime.strptime(value, date_format)
+        except ValueError:
+            pass
+    raise ValueError("'%s' is not a valid date-time." % value)
+
+
+def filter_listing(query, model):
+    """Applies the filters and the page requested to a query on the given model.
+        Returns the new query and its maximum size (None if unlimited)."""
+    time_filters = (('created_after', lambda d: model.created_at > d),
+                    ('created_before', lambda d: model.created_at < d),
+                    ('deleted_after', lambda d: model.deleted_at > d),
+                    ('deleted_before', lambda d: model.deleted_at < d))
+    for param_name, condition in time_filters:
+        if request.args.get(param_name):
+            query = query.filter(condition(parse_datetime(request.args.get(param_name))))
+
+    if request.args.get('after'):
+        try:
+            query = query.filter(model.id > int(request.args.get('after')))
+        except ValueError:
+            raise ValueError("The 'after' parameter must be an identifier.")
+    # Paging by identifier (i.e., keyset pagination) does not get slower on further pages.
+    query = query.order_by(None).order_by(model.id)
+
+    limit = None
+    if request.args.get('limit'):
+        try:
+            limit = int(request.args.get('limit'))
+        except ValueError:
+            limit = 0
+        if limit < 1:
+            raise ValueError("The 'limit' parameter must be a positive integer.")
+        query = query.limit(limit)
+    return query, limit
+
+
+def get_next_page_url(last_id):
+    params = request.args.to_dict()
+    params['after'] = last_id
+    return url_for(request.endpoint, _external=True, **params)
+
+
+def stream_listing(name, query, limit, serialize):
+    yield '{"%s": [' % name
+    count = 0
+    last_id = None
+    for element in query.yield_per(100):  # Do not load all of them at once
+        if count:
+            yield ', '
+        yield json.dumps(serialize(element))
+        count += 1
+        last_id = element.id
+    next_url = get_next_page_url(last_id) if limit and count == limit else None
+    yield '], "next": %s}' % json.dumps(next_url)
+
+
+def get_json_listing(name, query, model, serialize):
+    """Returns the elements of the query which match the request parameters."""
+    try:
+        query, limit = filter_listing(query, model)
+    except ValueError as e:
+        return bad_request(error=e.args[0])
+
+    if request.args.get('stream', 'false').lower() in ('true', '1'):
+        return Response(stream_with_context(stream_listing(name, query, limit, serialize)),
+                        mimetype='application/json')
+
+    elements = query.all()
+    next_url = get_next_page_url(elements[-1].id) if limit and len(elements) == limit else None
+    return jsonify(**{name: [serialize(el) for el in elements], 'next': next_url})
+
+
 def get_json_allocations(allocations):
     h = get_host()
-    return jsonify(allocations=[al.serialize("%s/%d" % (request.base_url, al.id), h) for al in allocations])
+    return get_json_listing('allocations', allocations, Allocation,
+                            lambda al: al.serialize("%s/%d" % (request.base_url, al.id), h))
 
 
 @app.route("/allocations")
@@ -116,11 +216,47 @@ def list_allocations():
         description: Show different allocations
         default: current
         enum: [all, current, finished]
+      - name: limit
+        in: query
+        type: integer
+        description: Maximum number of elements returned. If there are more, the response includes the URL of the next page.
+      - name: after
+        in: query
+        type: integer
+        description: Only return elements whose identifier is greater than this one (i.e., the next page).
+      - name: created_after
+        in: query
+        type: string
+        format: date-time
+        description: Only return elements created after this moment.
+      - name: created_before
+        in: query
+        type: string
+        format: date-time
+        description: Only return elements created before this moment.
+      - name: deleted_after
+        in: query
+        type: string
+        format: date-time
+        description: Only return elements deleted after this moment.
+      - name: deleted_before
+        in: query
+        type: string
+        format: date-time
+        description: Only return elements deleted before this moment.
+      - name: stream
+        in: query
+        type: boolean
+        description: Send the elements as they are read from the database.
+        default: false
     responses:
       200:
         description: Allocations of Packet Tracer instances
         schema:
             properties:
+                next:
+                    type: string
+                    description: URL of the next page (if there is any).
                 allocations:
                     type: array
                     items:
@@ -134,7 +270,7 @@ def list_allocations():
             return BadRequest("The 'show' parameter must contain one of the following values: all, running or finished.")
 
         if show_param == "all":
-            return get_json_allocations(Allocation.get_all())  # .limit(10)
+            return get_json_allocations(Allocation.get_all())
         else:  # show_param is "finished":
             return get_json_allocations(Allocation.get_finished())
 
@@ -146,6 +282,16 @@ def allocate_instance():
     ---
     tags:
         - allocation
+    parameters:
+      - name: async
+        in: query
+        type: boolean
+        description: Do not wait for the allocation, return a request to poll instead. Sending the 'Prefer: respond-async' header has the same effect.
+        default: false
+      - name: count
+        in: query
+        type: integer
+        description: Allocate several instances at once (at most as many as ports available). The response then contains the list of allocations, which might be shorter than requested.
     responses:
         201:
             description: Packet Tracer instance allocated (i.e., allocation created)
@@ -169,6 +315,10 @@ def allocate_instance():
                         type: string
                         format: date-time
                         description: When was the allocation removed/stopped?
+        202:
+            description: The allocation has been requested (only in asynchronous mode)
+            schema:
+                $ref: '#/definitions/show_allocation_request_get_AllocationRequest'
         500:
             description: The instance could not be allocated, there was an error.
             schema:
@@ -185,19 +335,276 @@ def allocate_instance():
             schema:
                 $ref: '#/definitions/allocate_instance_post_Error'
     """
+    if request.args.get("count") is not None:
+        return allocate_several_instances(request.args.get("count"))
+
+    trace = tracing.start('web')
+
+    @after_this_request
+    def add_trace_header(response):
+        response.headers['X-Trace-Id'] = trace.trace_id
+        return response
+
+    allocation_id = None
     try:
-        result = tasks.allocate_instance.apply_async()
-        allocation_id = result.get()
-        if allocation_id:
-            allocation = Allocation.get(allocation_id)
-            return jsonify(allocation.serialize("%s/%d" % (request.base_url, allocation.id), get_host()))
-        return unavailable()
+        with tracing.span('enqueue'):
+            result = tasks.allocate_instance.apply_async(headers=trace.get_headers())
+        if is_async_request():
+            redis_store.setex(ALLOCATION_REQUEST_KEY % result.id, ALLOCATION_REQUEST_TTL, 1)
+            resp = jsonify(get_allocation_request(result))
+            resp.status_code = 202
+            resp.headers['Location'] = url_for('show_allocation_request', request_id=result.id, _external=True)
+            return resp
+
+        try:
+            with tracing.span('wait'):
+                allocation_id = result.get()
+            if allocation_id:
+                with tracing.span('serialize'):
+                    allocation = Allocation.get(allocation_id)
+                    return jsonify(allocation.serialize("%s/%d" % (request.base_url, allocation.id), get_host()))
+            return unavailable()
+        except TaskRevokedError:
+            return unavailable('timeout got during instance allocation')
+        except InsufficientResourcesError as ire:
+            return unavailable(ire.args[0])
+        except DockerContainerError as e:
+            return internal_error(e.args[0])
+    finally:
+        tracing.finish(allocation_id)
+
+
+def allocate_several_instances(count):
+    try:
+        count = int(count)
+    except ValueError:
+        count = 0
+    if count < 1:
+        return bad_request(error="The 'count' parameter must be a positive integer.")
+    max_count = app.config['HIGHEST_PORT'] - app.config['LOWEST_PORT'] + 1
+    if count > max_count:
+        return bad_request(error="The 'count' parameter cannot be greater than %d (the available ports)." % max_count)
+    if is_async_request():
+        return bad_request(error="Several instances cannot be allocated asynchronously.")
+
+    try:
+        result = tasks.allocate_instances.apply_async(args=(count,))
+        allocation_ids = result.get()
     except TaskRevokedError:
         return unavailable('timeout got during instance allocation')
     except InsufficientResourcesError as ire:
         return unavailable(ire.args[0])
-    except DockerContainerError as e:
-        return internal_error(e.args[0])
+
+    missing = count - len(allocation_ids)
+    if missing > 0:
+        # Created by any available worker at the same time instead of one after the other.
+        created = group(tasks.create_instance.s(allocate=True) for _ in range(missing)).apply_async()
+        instance_ids = []
+        for instance_id in created.join(propagate=False):
+            if isinstance(instance_id, Exception):  # E.g., no more ports available
+                logger.error('An instance could not be allocated. %s' % instance_id)
+            else:
+                instance_ids.append(instance_id)
+        allocation_ids += [instance.allocated_by for instance in Instance.get_many(instance_ids)]
+    if not allocation_ids:
+        return unavailable('No instance could be allocated.')
+    h = get_host()
+    return jsonify(requested=count,
+                   allocations=[al.serialize("%s/%d" % (request.base_url, al.id), h) for al in Allocation.get_many(allocation_ids)])
+
+
+def is_async_request():
+    if request.args.get("async", "false").lower() in ("true", "1"):
+        return True
+    return 'respond-async' in request.headers.get('Prefer', '')
+
+
+def get_allocation_request(result):
+    """Returns the state of the allocation requested in an easily serializeable format."""
+    ret = {
+        'id': result.id,
+        'url': url_for('show_allocation_request', request_id=result.id, _external=True),
+        'status': 'pending',
+        'allocation': None,
+        'message': None
+    }
+    if result.ready():
+        if result.successful() and result.result:
+            ret['status'] = 'finished'
+            allocation = Allocation.get(result.result)
+            allocation_url = url_for('show_allocation_details', allocation_id=allocation.id, _external=True)
+            ret['allocation'] = allocation.serialize(allocation_url, get_host())
+        else:
+            ret['status'] = 'failed'
+            if isinstance(result.result, TaskRevokedError):
+                ret['message'] = 'timeout got during instance allocation'
+            elif isinstance(result.result, Exception) and result.result.args:
+                ret['message'] = result.result.args[0]
+            else:
+                ret['message'] = 'The instance could not be allocated.'
+    return ret
+
+
+@app.route("/allocation-requests/<request_id>")
+def show_allocation_request(request_id):
+    """
+    Shows the state of an asynchronous allocation request.
+    ---
+    tags:
+      - allocation
+    parameters:
+      - name: request_id
+        in: path
+        type: string
+        description: allocation request identifier
+        required: true
+      - name: wait
+        in: query
+        type: number
+        format: float
+        description: Seconds to wait for the allocation to finish before answering (long polling).
+        default: 0
+    responses:
+      200:
+        description: State of the allocation request.
+        schema:
+            id: AllocationRequest
+            properties:
+                id:
+                    type: string
+                    description: Identifier of the allocation request
+                url:
+                    type: string
+                    description: URL to poll the allocation request
+                status:
+                    type: string
+                    enum: [pending, finished, failed]
+                    description: Has the allocation already finished?
+                allocation:
+                    $ref: '#/definitions/allocate_instance_post_Allocation'
+                message:
+                    type: string
+                    description: Why did the allocation fail?
+      400:
+        description: The 'wait' parameter is not a number.
+        schema:
+            $ref: '#/definitions/allocate_instance_post_Error'
+      404:
+        description: There is not an allocation request with the given request_id (or it has expired).
+        schema:
+            $ref: '#/definitions/allocate_instance_post_Error'
+    """
+    try:
+        wait = min(float(request.args.get("wait", 0)), app.config['MAXIMUM_WAIT'])
+    except ValueError:
+        return bad_request(error="The 'wait' parameter must be a number of seconds.")
+    if not redis_store.exists(ALLOCATION_REQUEST_KEY % request_id):
+        return not_found(error="The allocation request does not exist.")
+
+    result = tasks.allocate_instance.AsyncResult(request_id)
+    if wait > 0 and not result.ready():
+        try:
+            result.get(timeout=wait, propagate=False)
+        except CeleryTimeoutError:
+            pass  # Still pending
+    return jsonify(get_allocation_request(result))
+
+
+@app.route("/allocation-traces")
+def list_slow_allocation_traces():
+    """
+    Lists the latest allocations which were slow, with the time spent in each of their stages.
+    ---
+    tags:
+      - allocation
+    parameters:
+      - name: limit
+        in: query
+        type: integer
+        description: Maximum number of traces returned.
+        default: 20
+    responses:
+      200:
+        description: Slow allocations (the most recent first).
+        schema:
+            properties:
+                traces:
+                    type: array
+                    items:
+                      $ref: '#/definitions/show_allocation_trace_get_AllocationTrace'
+      400:
+        description: The 'limit' parameter is not a positive integer.
+        schema:
+            $ref: '#/definitions/allocate_instance_post_Error'
+    """
+    limit = request.args.get('limit', '20')
+    if not limit.isdigit() or int(limit) < 1:
+        return bad_request(error="The 'limit' parameter must be a positive integer.")
+    return jsonify(traces=tracing.get_slow(int(limit)))
+
+
+@app.route("/allocation-traces/<trace_id>")
+def show_allocation_trace(trace_id):
+    """
+    Shows the time spent in each stage of a recent allocation.
+    The identifier of the trace is returned in the 'X-Trace-Id' header of the allocation response.
+    ---
+    tags:
+      - allocation
+    parameters:
+      - name: trace_id
+        in: path
+        type: string
+        description: trace identifier
+        required: true
+    responses:
+      200:
+        description: Stages of the allocation.
+        schema:
+            id: AllocationTrace
+            properties:
+                id:
+                    type: string
+                    description: Identifier of the trace
+                allocation:
+                    type: integer
+                    description: Identifier of the allocation created (if any)
+                startedAt:
+                    type: number
+                    description: When was the allocation requested (seconds since the epoch)?
+                duration:
+                    type: number
+                    description: Seconds that the allocation took.
+                spans:
+                    type: array
+                    items:
+                      id: Span
+                      properties:
+                        name:
+                            type: string
+                            description: Stage of the allocation.
+                        process:
+                            type: string
+                            enum: [web, worker]
+                            description: Where was it measured?
+                        start:
+                            type: number
+                            description: Seconds since the allocation was requested.
+                        duration:
+                            type: number
+                            description: Seconds spent in the stage.
+                        depth:
+                            type: integer
+                            description: Nesting level (e.g., the stages of an inline instance creation are nested).
+      404:
+        description: There is no trace with this identifier (they are only kept for a while).
+        schema:
+            $ref: '#/definitions/allocate_instance_post_Error'
+    """
+    trace = tracing.get(trace_id)
+    if not trace:
+        return not_found(error="The trace does not exist or it has expired.")
+    return jsonify(trace)
 
 
 @app.route("/allocations/<allocation_id>")
@@ -273,7 +680,8 @@ def deallocate_instance(allocation_id):
 
 def get_json_instances(instances):
     h = get_host()
-    return jsonify(instances=[ins.serialize("%s/%d" % (request.base_url, ins.id), h) for ins in instances])
+    return get_json_listing('instances', instances, Instance,
+                            lambda ins: ins.serialize("%s/%d" % (request.base_url, ins.id), h))
 
 
 @app.route("/instances")
@@ -290,11 +698,47 @@ def list_instances():
         description: Show different types of instances
         default: running
         enum: [all, starting, deallocated, allocated, running, finished, error]
+      - name: limit
+        in: query
+        type: integer
+        description: Maximum number of elements returned. If there are more, the response includes the URL of the next page.
+      - name: after
+        in: query
+        type: integer
+        description: Only return elements whose identifier is greater than this one (i.e., the next page).
+      - name: created_after
+        in: query
+        type: string
+        format: date-time
+        description: Only return elements created after this moment.
+      - name: created_before
+        in: query
+        type: string
+        format: date-time
+        description: Only return elements created before this moment.
+      - name: deleted_after
+        in: query
+        type: string
+        format: date-time
+        description: Only return elements deleted after this moment.
+      - name: deleted_before
+        in: query
+        type: string
+        format: date-time
+        description: Only return elements deleted before this moment.
+      - name: stream
+        in: query
+        type: boolean
+        description: Send the elements as they are read from the database.
+        default: false
     responses:
       200:
         description: Packet Tracer instances
         schema:
             properties:
+                next:
+                    type: string
+                    description: URL of the next page (if there is any).
                 instances:
                     type: array
                     items:
@@ -313,7 +757,7 @@ def list_instances():
             return BadRequest("The 'show' parameter must contain one of the following values: %s." % state_enum)
 
         if show_param == "all":
-            return get_json_instances(Instance.get_all())  # .limit(10)
+            return get_json_instances(Instance.get_all())
         elif show_param == "starting":
             return get_json_instances(Instance.get_starting())
         elif show_param == "deallocated":
@@ -453,6 +897,81 @@ def delete_instance(instance_id):
     return jsonify(instance.serialize(request.base_url, get_host()))
 
 
+@app.route("/pool")
+def show_pool():
+    """
+    Shows the state of the pool of instances waiting to be allocated.
+    ---
+    tags:
+      - pool
+    responses:
+      200:
+        description: Size, configuration and usage of the pool.
+        schema:
+            id: Pool
+            properties:
+                ready:
+                    type: integer
+                    description: Deallocated instances which can be allocated right away.
+                starting:
+                    type: integer
+                    description: Deallocated instances which are still starting.
+                minIdle:
+                    type: integer
+                    description: The pool is refilled below this number of deallocated instances.
+                maxIdle:
+                    type: integer
+                    description: The pool is shrunk above this number of deallocated instances.
+                refillRate:
+                    type: integer
+                    description: Maximum number of instances created on each check.
+                checkInterval:
+                    type: integer
+                    description: Seconds between checks.
+                hits:
+                    type: integer
+                    description: Allocations served by an already running instance.
+                misses:
+                    type: integer
+                    description: Allocations which needed to create a new instance.
+                hitRate:
+                    type: number
+                    format: float
+                    description: Ratio of allocations served by an already running instance.
+                created:
+                    type: integer
+                    description: Instances created to refill the pool.
+                removed:
+                    type: integer
+                    description: Instances removed to shrink the pool.
+                lastRefill:
+                    type: string
+                    format: date-time
+                    description: When was the pool refilled for the last time?
+    """
+    stats = pool.get_stats()
+    deallocated = Instance.get_deallocated()
+    stats['starting'] = deallocated.filter(Instance.status == Instance.STARTING).count()
+    stats['ready'] = deallocated.filter(Instance.status == Instance.READY).count()
+    return jsonify(stats)
+
+
+@app.route("/metrics")
+def show_metrics():
+    """
+    Exports metrics about the allocations, the instances and the cache in the Prometheus text format.
+    ---
+    tags:
+      - metrics
+    produces:
+      - text/plain
+    responses:
+      200:
+        description: Durations of the tasks, failures, pool usage, instances by status, free ports, cached files and queued tasks.
+    """
+    return Response(metrics.render(), content_type='text/plain; version=0.0.4; charset=utf-8')
+
+
 @app.route("/ports")
 def list_ports():
     """
@@ -519,17 +1038,6 @@ def list_cached_files():
     return jsonify(files=[cached_file.serialize(c_dir) for cached_file in CachedFile.get_all()])
 
 
-def delete_file(cached_file):
-    try:
-        os.remove(app.config['CACHE_DIR'] + cached_file.filename)
-        CachedFile.delete(cached_file)
-    except OSError as e:  # E.g., if the file does not exist.
-        if e.errno==errno.ENOENT:
-            # We wanted to delete it anyway so go ahead
-            CachedFile.delete(cached_file)
-        else: raise  # E.g., permission denied
-
-
 @app.route("/files", methods=['DELETE'])
 def clear_cache():
     """
@@ -555,7 +1063,7 @@ def clear_cache():
     c_dir = app.config['CACHE_CONTAINER_DIR']
     for cached_file in CachedFile.get_all():
         try:
-            delete_file(cached_file)  # TODO capture errors?
+            filecache.delete(cached_file)  # TODO capture errors?
         except OSError as e:
             return internal_error(('Error during the file removal from the cache. %s. ' +
                                 'The exception raised with the following file: %s') %
@@ -564,17 +1072,6 @@ def clear_cache():
     return jsonify(files=deleted_files)
 
 
-def get_and_update_cached_file(file_url):
-    """Returns cached file for the given URL only if the file exists."""
-    cached_file = CachedFile.get(file_url)
-    if cached_file:
-        # check if the file still exists and remove the object from the DB otherwise
-        if os.path.isfile(app.config['CACHE_DIR'] + cached_file.filename):
-            return cached_file
-        CachedFile.delete(cached_file)  # else
-    return None
-
-
 @app.route("/files/<path:file_url>")
 def get_cached_file(file_url):
     """
@@ -605,15 +1102,20 @@ def get_cached_file(file_url):
         schema:
           $ref: '#/definitions/allocate_instance_post_Error'
     """
-    cached_file = get_and_update_cached_file(file_url)
+    cached_file = filecache.get_and_update_cached_file(file_url)
     if not cached_file:
         return not_found(error="The URL is not cached.")
     return jsonify(cached_file.serialize(app.config['CACHE_CONTAINER_DIR']))
 
 
-# Source: http://stackoverflow.com/questions/2257441/random-string-generation-with-upper-case-letters-and-digits-in-python
-def get_random_name(length=32):
-    return ''.join(random.SystemRandom().choice(string.ascii_lowercase + string.digits) for _ in range(length)) + '.pkt'
+def get_max_age():
+    """Returns the maximum age requested for the cached files (None if not provided)."""
+    max_age = request.args.get('max_age')
+    if max_age is None:
+        return None
+    if not max_age.isdigit():
+        raise ValueError("The 'max_age' parameter must be a number of seconds.")
+    return int(max_age)
 
 
 @app.route("/files", methods=['POST'])
@@ -629,39 +1131,120 @@ def cache_file():
         description: URL of the file to be cached.
         required: true
         type: string
+      - name: max_age
+        in: query
+        type: integer
+        description: Seconds after which the server will be asked whether the file has changed (0 means never). By default, the one in the configuration.
     responses:
       201:
         description: Packet Tracer file cached.
         schema:
             $ref: '#/definitions/get_cached_file_get_File'
       400:
-        description: The URL could not be accessed. It might not exist.
+        description: The URL could not be accessed (it might not exist) or the file is too large.
         schema:
             $ref: '#/definitions/allocate_instance_post_Error'
       500:
         description: The body of the request was incorrect. Please provide a valid file URL.
         schema:
             $ref: '#/definitions/allocate_instance_post_Error'
+      503:
+        description: Another request is still downloading the same URL.
+        schema:
+            $ref: '#/definitions/allocate_instance_post_Error'
     """
     file_url = request.data
     if not file_url:
         return internal_error('Empty body.')
 
-    cached_file = get_and_update_cached_file(file_url)
-    if cached_file:
-        return  jsonify(cached_file.serialize(app.config['CACHE_CONTAINER_DIR']))
-    # if not exist download and store
-    filename = get_random_name()
     try:
-        with open(app.config['CACHE_DIR'] + filename, 'w') as f:
-            f.write(urllib2.urlopen(file_url).read())
+        max_age = get_max_age()
+    except ValueError as e:
+        return bad_request(error=e.args[0])
+
+    try:
+        cached_file = filecache.cache(file_url, max_age)  # Downloaded only if needed
+    except FileTooLargeError as e:
+        return bad_request(error=e.args[0])
+    except DownloadInProgressError as e:
+        return unavailable(e.args[0])
+    except ValueError:  # Before IOError: invalid URLs are both
+        return internal_error('Invalid URL passed in the body.')
     except IOError:
         return bad_request(error="The URL passed could not be reached. Is '%s' correct?" % file_url)
+    return jsonify(cached_file.serialize(app.config['CACHE_CONTAINER_DIR']))
+
+
+@app.route("/files/prefetch", methods=['POST'])
+def prefetch_files():
+    """
+    Caches several Packet Tracer files at once.
+    Files already cached are skipped and the rest are downloaded in parallel.
+    ---
+    tags:
+      - file
+    parameters:
+      - name: file_urls
+        in: body
+        description: JSON list with the URLs of the files to be cached.
+        required: true
+        schema:
+          type: array
+          items:
+            type: string
+      - name: max_age
+        in: query
+        type: integer
+        description: Seconds after which the server will be asked whether the files have changed (0 means never). By default, the one in the configuration.
+      - name: stream
+        in: query
+        type: boolean
+        description: Send the outcome of each URL as soon as it is known (one JSON object per line).
+    responses:
+      200:
+        description: Outcome of each URL.
+        schema:
+            properties:
+                files:
+                    type: array
+                    items:
+                      id: Prefetch
+                      properties:
+                        url:
+                            type: string
+                            description: URL of the file.
+                        status:
+                            type: string
+                            enum: [cached, downloaded, downloading, failed]
+                            description: Whether it was already cached, it has been downloaded, another request is downloading it or it could not be downloaded.
+                        size:
+                            type: integer
+                            description: Bytes downloaded.
+                        error:
+                            type: string
+                            description: Why it was not downloaded.
+      400:
+        description: The body of the request was incorrect. Please provide a list of URLs.
+        schema:
+            $ref: '#/definitions/allocate_instance_post_Error'
+    """
+    try:
+        file_urls = json.loads(request.data)
     except ValueError:
-        return internal_error('Invalid URL passed in the body.')
+        file_urls = None
+    if not isinstance(file_urls, list) or not all(isinstance(url, basestring) for url in file_urls):
+        return bad_request(error='The body must be a JSON list of URLs.')
+
+    try:
+        max_age = get_max_age()
+    except ValueError as e:
+        return bad_request(error=e.args[0])
 
-    new_cached = CachedFile.create(file_url, filename)
-    return jsonify(new_cached.serialize(app.config['CACHE_CONTAINER_DIR']))
+    progress = filecache.prefetch(file_urls, max_age)
+    if request.args.get('stream', 'false').lower() in ('true', '1'):
+        lines = (json.dumps(outcome) + '\n' for outcome in progress)
+        return Response(stream_with_context(lines), mimetype='application/x-ndjson')
+    return jsonify(files=list(progress))
 
 
 @app.route("/files/<path:file_url>", methods=['DELETE'])
@@ -687,8 +1270,8 @@ def delete_file_from_cache(file_url):
         schema:
             $ref: '#/definitions/allocate_instance_post_Error'
     """
-    cached_file = get_and_update_cached_file(file_url)
+    cached_file = filecache.get_and_update_cached_file(file_url)
     if not cached_file:
         return not_found(error="The URL is not cached.")
-    delete_file(cached_file)
+    filecache.delete(cached_file)
     return  jsonify(cached_file.serialize(app.config['CACHE_CONTAINER_DIR']))
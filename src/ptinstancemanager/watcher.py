@@ -0,0 +1,31 @@
+"""
+Created on 16/10/2026
+
+Long-running process which supervises the containers using Docker events.
+
+Configuration file path is read from program args.
+"""
+
+from argparse import ArgumentParser
+from ptinstancemanager.config import configuration
+
+
+def main(config_file):
+	configuration.set_file_path(config_file)
+	from ptinstancemanager.main import load_app
+	app = load_app()
+	from ptinstancemanager.events import watch_events
+	with app.app_context():
+		watch_events()
+
+
+def entry_point():
+	parser = ArgumentParser(description='Update Packet Tracer instances as soon as their containers change.')
+	parser.add_argument('-config', default='../../config.ini', dest='config',
+	                    help='Configuration file.')
+	args = parser.parse_args()
+	main(args.config)
+
+
+if __name__ == "__main__":
+	entry_point()